@@ -0,0 +1,150 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from models.default_model import DefaultModel
+from game_evaluator import DeceptionGame, SavedGame
+
+
+# Scores saved games without the REPL: every .gm file named on the command
+# line (or found in a named directory) is loaded, evaluated in a pool of
+# worker processes, and written to stdout as one JSON line as soon as it's
+# done, e.g.
+#
+#   python batch.py games/ -j 4 --time 30 --tol 0.01 > scores.jsonl
+
+
+def save_files(paths):
+    out = []
+    for path in paths:
+        if os.path.isdir(path):
+            out.extend(sorted(os.path.join(path, name)
+                              for name in os.listdir(path)
+                              if name.endswith(".gm")))
+        else:
+            out.append(path)
+    return out
+
+
+def load_game(path, parameters=None):
+    with open(path, "r") as savefile:
+        observations = json.load(savefile)
+    metadata = observations[0]
+    game = DeceptionGame(SavedGame(metadata), DefaultModel)
+    if parameters:
+        game.set_parameters(parameters)
+    game.load_save(observations[1:])
+    return game, metadata.get("player_names", {})
+
+
+def posteriors(game, namemap):
+    report = game.report()
+    errors = game.get_player_errors()
+    out = []
+    for i, seat in enumerate(report):
+        player = {
+            "player": i,
+            "name": namemap.get(str(i), ""),
+            "good": seat["side"].get(True, 0.0),
+            "roles": dict((role, p) for role, p in seat["role"].items()
+                          if role != ""),
+        }
+        if errors is not None:
+            player["good error"] = errors[i]["side"].get(True)
+        out.append(player)
+    return out
+
+
+def score(job):
+    path, parameters, eval_kwargs = job
+    started = time.time()
+    try:
+        game, namemap = load_game(path, parameters)
+        if "length" not in eval_kwargs:
+            # The REPL's default number of repetitions.
+            eval_kwargs = dict(eval_kwargs,
+                               length=200 / (game.n_players - 4) * 2)
+        game.eval(**eval_kwargs)
+        return {
+            "file": path,
+            "game_size": game.n_players,
+            "constraints": len(game.seen),
+            "seconds": round(time.time() - started, 3),
+            "players": posteriors(game, namemap),
+        }
+    except Exception, e:
+        return {"file": path, "error": "%s: %s" % (type(e).__name__, e)}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Evaluate Tim the Enchanter save files in bulk.")
+    parser.add_argument("paths", nargs="+",
+                        help=".gm files, or directories of them")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="games to evaluate at once")
+    parser.add_argument("-n", "--length", type=int, default=None,
+                        help="sampling repetitions per game")
+    parser.add_argument("--time", type=float, default=None,
+                        help="seconds each game may sample for")
+    parser.add_argument("--tol", type=float, default=None,
+                        help="stop sampling a game once every player's "
+                        "odds are within +/- this")
+    parser.add_argument("--exact", action="store_true",
+                        help="weigh every deal exactly instead of sampling")
+    parser.add_argument("--quick", action="store_true",
+                        help="discount special roles")
+    parser.add_argument("--side-first", action="store_true",
+                        help="filter good/evil patterns before roles")
+    parser.add_argument("--mcmc", action="store_true",
+                        help="sample deals with swap moves instead of going "
+                        "through the deck")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="make the sampling repeatable")
+    parser.add_argument("--params", default=None,
+                        help="JSON file of model probabilities (see fit.py)")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    eval_kwargs = {
+        "quick": args.quick,
+        "exact": args.exact,
+        "side_first": args.side_first,
+        "mcmc": args.mcmc or None,
+        "tolerance": args.tol,
+        "time_budget": args.time,
+        "seed": args.seed,
+    }
+    if args.length is not None:
+        eval_kwargs["length"] = args.length
+    parameters = None
+    if args.params:
+        with open(args.params) as infile:
+            parameters = json.load(infile)
+    jobs = [(path, parameters, eval_kwargs)
+            for path in save_files(args.paths)]
+    pool = multiprocessing.Pool(max(1, args.jobs))
+    failed = 0
+    try:
+        for result in pool.imap_unordered(score, jobs):
+            if "error" in result:
+                failed += 1
+            sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,183 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+from deals import DealMatrix
+from models.default_model import DefaultModel
+from game_evaluator import DeceptionGame, AvalonGame, MISSION_SIZES
+
+
+# Times the evaluator on the shipped save files and on synthetic 5-10 player
+# games. Each case runs in a fresh process, so its peak memory is its own:
+#
+#   python benchmark.py --save before.json
+#   ... change something ...
+#   python benchmark.py --baseline before.json
+
+
+# Seconds metrics, then rates; compare() reports how each one moved.
+TIMINGS = ["init", "enumerate", "quick", "full", "report"]
+RATES = ["deals/s", "calls/s"]
+
+MODEL_CALLS = ["player_sees_player_and_claims", "mission", "votes",
+               "vec_player_sees_player_and_claims", "vec_mission",
+               "vec_votes"]
+
+
+def synthetic_save(n_players, seed=0):
+    # Three rounds of votes and missions consistent with a random deal.
+    rng = random.Random(seed)
+    deal = AvalonGame(n_players)
+    rng.shuffle(deal)
+    seen = []
+    for rnd in range(3):
+        size = MISSION_SIZES[n_players][rnd]
+        for attempt in range(2):
+            team = sorted(rng.sample(range(n_players), size))
+            votes = [rng.randint(0, 1) for _ in range(n_players)]
+            seen.append({"type": "vote", "team": team, "votes": votes,
+                         "round": rnd + 1, "fails required": 1})
+        spies = len([p for p in team if not deal[p][1]])
+        seen.append({"type": "mission", "team": team,
+                     "fails": min(spies, 1), "must fail": False,
+                     "round": rnd + 1})
+    return seen
+
+
+def cases(games_dir, sizes):
+    out = []
+    for path in sorted(glob.glob(os.path.join(games_dir, "*.gm"))):
+        with open(path) as savefile:
+            observations = json.load(savefile)
+        name = os.path.splitext(os.path.basename(path))[0]
+        out.append((name, int(observations[0]["game_size"]),
+                    observations[1:]))
+    for n in sizes:
+        out.append(("synthetic-%d" % n, n, synthetic_save(n)))
+    return out
+
+
+def count_calls(model, counts):
+    # Wraps the model's entry points on the instance, so both the
+    # observation closures and the vectorized evaluator hit the counters.
+    def counted(name, f):
+        def call(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return f(*args, **kwargs)
+        return call
+    for name in MODEL_CALLS:
+        if hasattr(model, name):
+            setattr(model, name, counted(name, getattr(model, name)))
+
+
+def timed(f, *args, **kwargs):
+    started = time.time()
+    out = f(*args, **kwargs)
+    return out, time.time() - started
+
+
+def run_case(job):
+    name, n_players, seen, options = job
+    result = {"case": name, "players": n_players}
+    game, result["init"] = timed(
+        lambda: DeceptionGame(AvalonGame(n_players), DefaultModel))
+    game.load_save(seen)
+    _, result["enumerate"] = timed(DealMatrix, game.all_permutations,
+                                   cache_dir=None)
+    eval_kwargs = {"length": options["length"],
+                   "vectorized": not options["python"],
+                   "exact": options["exact"],
+                   "seed": 0}
+    _, result["quick"] = timed(game.eval, quick=True, **eval_kwargs)
+    counts = {}
+    count_calls(game.model, counts)
+    _, result["full"] = timed(game.eval, **eval_kwargs)
+    _, result["report"] = timed(game.get_player_data)
+    passes = 1 if options["exact"] else options["length"]
+    full = max(result["full"], 1e-9)
+    result["deals"] = len(game.all_permutations)
+    result["deals/s"] = result["deals"] * passes / full
+    result["calls/s"] = sum(counts.values()) / full
+    result["peak MB"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return result
+
+
+def print_results(results, baseline):
+    columns = TIMINGS + RATES + ["peak MB"]
+    print "%-14s %3s %8s " % ("case", "n", "deals") + \
+        " ".join("%10s" % c for c in columns)
+    for result in results:
+        row = "%-14s %3d %8d " % (result["case"], result["players"],
+                                  result["deals"])
+        row += " ".join("%10.4g" % result[c] for c in columns)
+        print row
+        old = baseline.get(result["case"])
+        if old is not None:
+            print "%-14s %3s %8s " % ("  vs baseline", "", "") + \
+                " ".join("%10s" % change(old.get(c), result[c])
+                         for c in columns)
+
+
+def change(old, new):
+    # How many times bigger the new number is.
+    if not old:
+        return "-"
+    return "x%.2f" % (new / old)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Time DeceptionGame on saved and synthetic games.")
+    parser.add_argument("--games", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "games"),
+        help="directory of .gm files to include")
+    parser.add_argument("--sizes", default="5,6,7,8,9,10",
+                        help="player counts of the synthetic games")
+    parser.add_argument("--only", default=None,
+                        help="run only the cases whose name contains this")
+    parser.add_argument("-n", "--length", type=int, default=10,
+                        help="sampling repetitions per eval")
+    parser.add_argument("--exact", action="store_true",
+                        help="weigh every deal exactly instead of sampling")
+    parser.add_argument("--python", action="store_true",
+                        help="use the deal-by-deal evaluator")
+    parser.add_argument("--save", default=None,
+                        help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="compare against results saved earlier")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    sizes = [int(n) for n in args.sizes.split(",") if n]
+    options = {"length": args.length, "exact": args.exact,
+               "python": args.python}
+    jobs = [case + (options,) for case in cases(args.games, sizes)
+            if args.only is None or args.only in case[0]]
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = dict((r["case"], r) for r in json.load(infile))
+    # A fresh process per case keeps the peak memory figures apart.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(run_case, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, "w") as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,76 @@
+from collections import defaultdict as dd
+import math
+
+
+class Convergence(object):
+    # Tracks a sampled evaluation batch by batch, so we can tell how much
+    # the per-player side and role probabilities would still move.
+    #
+    # Every batch contributes the number of accepted samples and, for each
+    # (player, "side"/"role", value), how many of them had that card. The
+    # posterior is the ratio of the two sums; its 95% confidence half-width
+    # comes from the spread of the batches (delta method for a ratio).
+    def __init__(self, n_players, z=1.96):
+        self.n_players = n_players
+        self.z = z
+        self.totals = []
+        self.tallies = []
+
+    def add(self, trace):
+        # `trace` is one batch's deals.Trace.
+        tally = {}
+        for i, seat in enumerate(trace.tallies()):
+            for kind in ("role", "side"):
+                for value, count in seat[kind].items():
+                    tally[(i, kind, value)] = count
+        self.totals.append(trace.total())
+        self.tallies.append(tally)
+
+    def samples(self):
+        return sum(self.totals)
+
+    def half_width(self, key):
+        n = len(self.totals)
+        total = sum(self.totals)
+        if n < 2 or total == 0:
+            return None
+        ratio = sum(t.get(key, 0.0) for t in self.tallies) / total
+        mean = total / n
+        spread = sum((t.get(key, 0.0) - ratio * size) ** 2
+                     for t, size in zip(self.tallies, self.totals))
+        return self.z * math.sqrt(spread / (n * (n - 1))) / mean
+
+    def errors(self):
+        # Same shape as DeceptionGame.get_player_data().
+        out = []
+        for i in range(self.n_players):
+            out.append({"role": {}, "side": {}})
+        keys = set()
+        for tally in self.tallies:
+            keys.update(tally)
+        for key in keys:
+            i, kind, value = key
+            out[i][kind][value] = self.half_width(key)
+        return out
+
+    def converged(self, tolerance, min_batches=5, min_samples=100):
+        # Every player's chance of being good, and their most likely role,
+        # must be pinned down to within +/- tolerance. A handful of accepted
+        # samples can look perfectly stable, hence the minimums.
+        if len(self.totals) < min_batches or \
+           self.samples() < min_samples:
+            return False
+        for i in range(self.n_players):
+            roles = dd(float)
+            for tally in self.tallies:
+                for key, count in tally.items():
+                    if key[0] == i and key[1] == "role":
+                        roles[key[2]] += count
+            keys = [(i, "side", True)]
+            if roles:
+                keys.append((i, "role", max(roles, key=roles.get)))
+            for key in keys:
+                width = self.half_width(key)
+                if width is None or width > tolerance:
+                    return False
+        return True
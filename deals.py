@@ -0,0 +1,522 @@
+from collections import Counter
+import hashlib
+import numpy as np
+import os
+import tempfile
+
+
+# Where DealMatrix keeps enumerated decks between sessions; set
+# TIM_CACHE_DIR to move it, or to an empty string to turn the cache off.
+CACHE_DIR = os.environ.get(
+    "TIM_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "tim-the-enchanter")) \
+    or None
+
+# Bump when the cached table layout changes.
+TABLE_VERSION = 1
+
+
+def multinomial(counts):
+    # Number of distinct orderings of a multiset with the given multiplicities.
+    total = 1
+    n = 0
+    for c in counts:
+        for k in range(1, c + 1):
+            n += 1
+            total = total * n // k
+    return total
+
+
+def lancelots_flipped(switches, rnd):
+    # Whether the Lancelots have swapped sides in round `rnd`, given the
+    # rounds they switched at.
+    if rnd is None:
+        return False
+    if len(switches) == 1:
+        return rnd >= switches[0]
+    if len(switches) == 2:
+        return switches[0] <= rnd < switches[1]
+    return False
+
+
+class DealDeck(object):
+    # Every distinct way to hand out a multiset of cards, one per seat.
+    #
+    # Deals are generated lazily in lexicographic order (by the sorted card
+    # list), each unique assignment exactly once, and can be addressed by
+    # integer index: deck[i], deck.rank(deal) and deck.unrank(i) convert
+    # between a deal tuple and its position without walking the deck.
+    def __init__(self, cards):
+        counter = Counter(cards)
+        self.cards = sorted(counter)
+        self.counts = [counter[c] for c in self.cards]
+        self.n_players = len(cards)
+        self._len = multinomial(self.counts)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.iter_range(0, self._len)
+
+    def iter_range(self, start, stop):
+        # Knuth's algorithm L over card indices, starting from deck[start];
+        # it naturally skips repeats.
+        stop = min(stop, self._len)
+        if start >= stop:
+            return
+        cards = self.cards
+        card_index = dict((c, i) for i, c in enumerate(cards))
+        idx = [card_index[c] for c in self.unrank(start)]
+        n = len(idx)
+        for _ in range(stop - start):
+            yield tuple(cards[i] for i in idx)
+            j = n - 2
+            while j >= 0 and idx[j] >= idx[j + 1]:
+                j -= 1
+            if j < 0:
+                return
+            k = n - 1
+            while idx[k] <= idx[j]:
+                k -= 1
+            idx[j], idx[k] = idx[k], idx[j]
+            idx[j + 1:] = reversed(idx[j + 1:])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.unrank(x) for x in range(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        return self.unrank(i)
+
+    def __contains__(self, deal):
+        return len(deal) == self.n_players and \
+            Counter(deal) == Counter(dict(zip(self.cards, self.counts)))
+
+    def rank(self, deal):
+        counts = self.counts[:]
+        remaining = self.n_players
+        total = self._len
+        out = 0
+        for card in deal:
+            c = self.cards.index(card)
+            for lower in range(c):
+                if counts[lower]:
+                    out += total * counts[lower] // remaining
+            total = total * counts[c] // remaining
+            counts[c] -= 1
+            remaining -= 1
+        return out
+
+    def consistent(self, allowed, rules=(), limit=None):
+        # The deals, as a [deals, seats] array of indices into self.cards in
+        # deck order, where seat p holds a card c with allowed[p][c] and,
+        # for every rule (p, if_cards, q, then_cards), seat q holds one of
+        # then_cards whenever seat p holds one of if_cards (both boolean
+        # arrays over self.cards). Seats are dealt one at a time and partial
+        # deals dropped as soon as they break a rule or leave a card that
+        # the remaining seats can't take, so deals that can't happen are
+        # never built. None if that takes more than `limit` partial deals.
+        n_cards = len(self.cards)
+        allowed = np.array(allowed, dtype=bool)
+        rules = self.propagate(allowed, list(rules))
+        # capacity[p][c]: how many of seats p onwards can take card c.
+        capacity = np.zeros((self.n_players + 1, n_cards), dtype=np.int16)
+        capacity[:-1] = np.cumsum(allowed[::-1], axis=0)[::-1]
+        deals = np.zeros((1, 0), dtype=np.int8)
+        left = np.array([self.counts], dtype=np.int16)
+        for seat in range(self.n_players):
+            choices = np.nonzero(allowed[seat])[0]
+            part, pick = np.nonzero(left[:, choices] > 0)
+            dealt = choices[pick]
+            deals = np.column_stack([deals[part], dealt]).astype(np.int8)
+            left = left[part]
+            left[np.arange(len(part)), dealt] -= 1
+            keep = (left <= capacity[seat + 1]).all(axis=1)
+            for p, if_cards, q, then_cards in rules:
+                if max(p, q) == seat:
+                    keep &= ~if_cards[deals[:, p]] | then_cards[deals[:, q]]
+            deals = deals[keep]
+            left = left[keep]
+            if limit is not None and len(deals) > limit:
+                return None
+        return deals
+
+    def propagate(self, allowed, rules):
+        # Narrows `allowed` in place with what the rules and the card counts
+        # force, and returns the rules still left to check deal by deal.
+        good = np.array([card[1] for card in self.cards], dtype=bool)
+        groups = [np.arange(len(self.cards)) == c
+                  for c in range(len(self.cards))] + [good, ~good]
+        counts = np.array(self.counts)
+        changed = True
+        while changed:
+            changed = False
+            left = []
+            for p, if_cards, q, then_cards in rules:
+                if not (allowed[p] & if_cards).any():
+                    continue
+                if not (allowed[p] & ~if_cards).any():
+                    allowed[q] &= then_cards
+                    changed = True
+                elif not (allowed[q] & then_cards).any():
+                    allowed[p] &= ~if_cards
+                    changed = True
+                else:
+                    left.append((p, if_cards, q, then_cards))
+            rules = left
+            # Once as many seats as a group of cards has must hold cards of
+            # it, nobody else can.
+            for group in groups:
+                held = ~(allowed & ~group).any(axis=1)
+                if held.sum() == counts[group].sum():
+                    others = ~held & (allowed & group).any(axis=1)
+                    if others.any():
+                        allowed[others] &= ~group
+                        changed = True
+        return rules
+
+    def unrank(self, i):
+        if i < 0 or i >= self._len:
+            raise IndexError("deal index out of range")
+        counts = self.counts[:]
+        remaining = self.n_players
+        total = self._len
+        out = []
+        for _ in range(self.n_players):
+            for c, count in enumerate(counts):
+                if not count:
+                    continue
+                block = total * count // remaining
+                if i < block:
+                    out.append(self.cards[c])
+                    total = block
+                    counts[c] -= 1
+                    remaining -= 1
+                    break
+                i -= block
+        return tuple(out)
+
+
+# Bits per seat in DealRows' packed role codes.
+ROLE_BITS = 5
+ROLE_MASK = (1 << ROLE_BITS) - 1
+
+# POPCOUNT[m] is the number of set bits in the 16-bit mask m.
+POPCOUNT = np.array([bin(m).count("1") for m in range(1 << 16)],
+                    dtype=np.int8)
+
+
+def popcount(masks):
+    # Set bits in each of an array of (up to 32-bit) seat masks.
+    masks = np.asarray(masks, dtype=np.uint32)
+    return POPCOUNT[masks & 0xFFFF] + POPCOUNT[masks >> 16]
+
+
+def seat_mask(flags):
+    # Folds a [deals, seats] boolean array into one bitmask per deal.
+    mask = np.zeros(len(flags), dtype=np.uint32)
+    for p in range(flags.shape[1]):
+        mask |= flags[:, p].astype(np.uint32) << p
+    return mask
+
+
+def team_mask(team):
+    mask = 0
+    for player in team:
+        mask |= 1 << player
+    return mask
+
+
+# DealMatrix.shared()'s matrices, by deck and slice.
+SHARED_MATRICES = {}
+
+
+class DealMatrix(object):
+    # The deck as small integers, one row per deal: roles[d, p] indexes
+    # role_names, good[d] is the bitmask of seats that start out good and
+    # lance[d] the seats holding a Lancelot, whose bits flip while the
+    # Lancelots are switched. Seat p is bit 1 << p.
+    def __init__(self, deck, start=0, stop=None, cache_dir=CACHE_DIR):
+        # Only deck[start:stop] is held; row r is deal number start + r.
+        # With a cache_dir, the whole deck's table is built once, saved
+        # there and memory-mapped from then on, so restarts (and worker
+        # processes) share it rather than enumerating the deck again.
+        if stop is None:
+            stop = len(deck)
+        self.deck = deck
+        self.start = start
+        self.role_names = sorted(set(c[0] for c in deck.cards))
+        table = None
+        if cache_dir is not None:
+            table = self.cached_table(cache_dir)
+        if table is None:
+            table = self.build_table(start, stop)
+        else:
+            table = table[start:stop]
+        self.set_table(table)
+
+    @classmethod
+    def from_cards(cls, deck, cards):
+        # A matrix of just the given deals, a [deals, seats] array of
+        # indices into deck.cards, without enumerating the deck.
+        matrix = cls(deck, 0, 0, cache_dir=None)
+        matrix.set_table(matrix.card_table(cards))
+        return matrix
+
+    def set_table(self, table):
+        self.roles = table["roles"]
+        self.good = table["good"]
+        self.lance = table["lance"]
+        self._rows = None
+
+    @classmethod
+    def shared(cls, deck, start=0, stop=None):
+        # The one matrix (per process) for these deals. Matrices don't
+        # change once built, so all the games of a size, and their copies,
+        # can hold the same table and DealRows.
+        key = (tuple(deck.cards), tuple(deck.counts), start, stop)
+        if key not in SHARED_MATRICES:
+            SHARED_MATRICES[key] = cls(deck, start, stop)
+        return SHARED_MATRICES[key]
+
+    def table_dtype(self):
+        return np.dtype([("roles", np.int8, (self.deck.n_players,)),
+                         ("good", np.uint32),
+                         ("lance", np.uint32)])
+
+    def build_table(self, start, stop):
+        deck = self.deck
+        card_index = dict((c, i) for i, c in enumerate(deck.cards))
+        cards = np.fromiter((card_index[c]
+                             for deal in deck.iter_range(start, stop)
+                             for c in deal),
+                            dtype=np.int8,
+                            count=(stop - start) * deck.n_players)
+        return self.card_table(cards.reshape(stop - start, deck.n_players))
+
+    def card_table(self, cards):
+        # Table rows for deals given as indices into deck.cards.
+        deck = self.deck
+        role_ids = dict((r, i) for i, r in enumerate(self.role_names))
+        card_roles = np.array([role_ids[c[0]] for c in deck.cards],
+                              dtype=np.int8)
+        table = np.empty(len(cards), dtype=self.table_dtype())
+        table["roles"] = roles = card_roles[cards]
+        card_sides = np.array([c[1] for c in deck.cards], dtype=bool)
+        table["good"] = seat_mask(card_sides[cards])
+        table["lance"] = seat_mask((roles == self.role_id("GLance")) |
+                                   (roles == self.role_id("ELance")))
+        return table
+
+    def cached_table(self, cache_dir):
+        # The whole deck's table, memory-mapped from cache_dir; None if the
+        # cache can't be read or written.
+        key = repr((TABLE_VERSION, self.deck.cards, self.deck.counts))
+        path = os.path.join(cache_dir,
+                            "%s.npy" % hashlib.sha1(
+                                key.encode("utf-8")).hexdigest()[:20])
+        try:
+            table = np.load(path, mmap_mode="r")
+            if table.dtype == self.table_dtype() and \
+               table.shape == (len(self.deck),):
+                return table
+        except (IOError, OSError, ValueError):
+            pass
+        table = self.build_table(0, len(self.deck))
+        out = None
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Written under a temporary name and renamed into place, so a
+            # concurrent reader never maps half a file.
+            out = tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp",
+                                              delete=False)
+            with out:
+                np.save(out, table)
+            os.chmod(out.name, 0o644)
+            os.rename(out.name, path)
+            return np.load(path, mmap_mode="r")
+        except (IOError, OSError):
+            # Don't leave a half-written file behind for every failed try.
+            if out is not None and os.path.exists(out.name):
+                try:
+                    os.unlink(out.name)
+                except OSError:
+                    pass
+            return table
+
+    def __len__(self):
+        return len(self.roles)
+
+    def role_id(self, role):
+        try:
+            return self.role_names.index(role)
+        except ValueError:
+            return -1
+
+    def deal(self, i):
+        good = int(self.good[i])
+        return tuple((self.role_names[r], bool(good >> p & 1))
+                     for p, r in enumerate(self.roles[i]))
+
+    def rows(self):
+        if self._rows is None:
+            self._rows = DealRows(self)
+        return self._rows
+
+    def view(self, idx, switches):
+        return DealView(self, idx, switches)
+
+
+def shared_ints(array):
+    # array.tolist(), with equal values sharing one int object.
+    seen = {}
+    return [seen.setdefault(x, x) for x in array.tolist()]
+
+
+class DealRows(object):
+    # A DealMatrix as plain Python ints, for the scalar model helpers: a
+    # deal is its row number, and every helper is a shift and a mask.
+    # Each deal's roles are packed ROLE_BITS to a seat.
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.role_names = matrix.role_names
+        n_players = matrix.deck.n_players
+        if ROLE_BITS * n_players <= 63:
+            codes = np.zeros(len(matrix), dtype=np.int64)
+            for p in range(n_players):
+                codes |= matrix.roles[:, p].astype(np.int64) << \
+                    (ROLE_BITS * p)
+            self.codes = codes.tolist()
+        else:
+            self.codes = [sum(int(r) << (ROLE_BITS * p)
+                              for p, r in enumerate(row))
+                          for row in matrix.roles]
+        self.good = shared_ints(matrix.good)
+        self.lance = shared_ints(matrix.lance)
+        self._seats = {}
+
+    def good_mask(self, deal, flipped):
+        if flipped:
+            return self.good[deal] ^ self.lance[deal]
+        return self.good[deal]
+
+    def role(self, deal, player):
+        return self.role_names[
+            self.codes[deal] >> (ROLE_BITS * player) & ROLE_MASK]
+
+    def seat_of(self, deal, role):
+        # The first seat holding `role`, or -1.
+        if role not in self._seats:
+            hits = self.matrix.roles == self.matrix.role_id(role)
+            self._seats[role] = np.where(hits.any(axis=1),
+                                         hits.argmax(axis=1), -1).tolist()
+        return self._seats[role][deal]
+
+
+class DealView(object):
+    # A subset of a DealMatrix, with the per-round helpers the vectorized
+    # model functions use. Every helper answers for all deals at once.
+    def __init__(self, matrix, idx, switches):
+        self.matrix = matrix
+        self.idx = idx
+        self.roles = matrix.roles[idx]
+        self.good = matrix.good[idx]
+        self.lance = matrix.lance[idx]
+        self.switches = list(switches)
+        self._spies = {}
+
+    def __len__(self):
+        return len(self.idx)
+
+    def good_mask(self, rnd):
+        if lancelots_flipped(self.switches, rnd):
+            return self.good ^ self.lance
+        return self.good
+
+    def is_good(self, player, rnd):
+        return (self.good_mask(rnd) >> player & 1).astype(bool)
+
+    def is_role(self, player, role):
+        return self.roles[:, player] == self.matrix.role_id(role)
+
+    def has_role(self, role):
+        return self.matrix.role_id(role) != -1
+
+    def team_has_role(self, team, role):
+        return (self.roles[:, team] == self.matrix.role_id(role)).any(axis=1)
+
+    def id_for_role(self, role):
+        hits = self.roles == self.matrix.role_id(role)
+        return np.where(hits.any(axis=1), hits.argmax(axis=1), -1)
+
+    def n_spies(self, team, rnd):
+        key = (tuple(team), lancelots_flipped(self.switches, rnd))
+        if key not in self._spies:
+            mask = np.uint32(team_mask(team))
+            self._spies[key] = popcount(mask & ~self.good_mask(rnd))
+        return self._spies[key]
+
+
+class Trace(object):
+    # The result of an eval: how often (or, when exact, how likely) each
+    # deal of a DealMatrix was accepted, as an array indexed by row.
+    def __init__(self, matrix, counts=None):
+        self.matrix = matrix
+        if counts is None:
+            counts = np.zeros(len(matrix))
+        self.counts = counts
+
+    def __len__(self):
+        # The number of deals that were accepted at all.
+        return int(np.count_nonzero(self.counts))
+
+    def add(self, other):
+        self.counts += other.counts
+
+    def total(self):
+        return float(self.counts.sum())
+
+    def sparse(self):
+        # The accepted rows and their counts.
+        rows = np.nonzero(self.counts)[0]
+        return rows, self.counts[rows]
+
+    def marginals(self):
+        # tallies() as fractions of the total: for each seat, the chance of
+        # each side and each role.
+        size = self.total()
+        out = self.tallies()
+        for seat in out:
+            for kind in ("role", "side"):
+                for value in seat[kind]:
+                    seat[kind][value] /= size
+        return out
+
+    def tallies(self):
+        # For each seat, the summed counts of the deals by the side and the
+        # role they deal that seat; values no accepted deal has are left out.
+        rows, weights = self.sparse()
+        n_players = self.matrix.deck.n_players
+        n_roles = len(self.matrix.role_names)
+        seats = np.arange(n_players)
+        roles = self.matrix.roles[rows] + n_roles * seats
+        by_role = np.bincount(roles.ravel(),
+                              weights=np.repeat(weights, n_players),
+                              minlength=n_players * n_roles)
+        by_role = by_role.reshape(n_players, n_roles)
+        good_seats = self.matrix.good[rows, None] >> seats & 1
+        good = weights.dot(good_seats)
+        evil = weights.dot(1 - good_seats)
+        out = []
+        for p in seats:
+            sides = {True: good[p], False: evil[p]}
+            out.append({
+                "role": dict((role, float(by_role[p, r]))
+                             for r, role in enumerate(self.matrix.role_names)
+                             if by_role[p, r] > 0),
+                "side": dict((side, float(w)) for side, w in sides.items()
+                             if w > 0),
+            })
+        return out
@@ -0,0 +1,322 @@
+import argparse
+import multiprocessing
+import sys
+
+import numpy as np
+
+from batch import load_game, save_files
+from models.util import Monomial
+from vector_evaluator import statement_round
+
+
+# Fits the model's probabilities to an archive of finished games, e.g.
+#
+#   python fit.py archive/ -j 4 -o fitted.json
+#
+# and then `params load fitted.json` in the REPL. Record the true roles of a
+# finished game with known_role statements; a game without them still
+# counts, as a mixture over the deals that could have produced it, but only
+# if there aren't too many of those (--max-deals).
+#
+# The model's likelihoods are products of True/None and chance() factors, so
+# with BaseModel.symbolic set each one comes out as a util.Monomial: a
+# coefficient and the powers of p and 1 - p for every parameter. Those
+# powers are worked out once per game, deal and decision; after that, the
+# log-likelihood of the archive under any parameters is a few matrix
+# products, which is what the optimizer evaluates.
+#
+# The model doesn't normalize its answers (a good player approving a bad
+# team scores `ignorance`, rejecting it scores 1), so maximizing its raw
+# likelihood would push every probability to 1. Each decision is scored
+# relative to what the player could have done instead: every vote against
+# the same vote flipped, a mission's fails against every other count, a
+# Lady claim against the opposite claim.
+
+
+def decisions(statement):
+    # The statements a player could have made instead, observed first: one
+    # list per separate decision.
+    type = statement["type"]
+    if type == "vote":
+        out = []
+        for player, vote in enumerate(statement["votes"]):
+            flipped = list(statement["votes"])
+            flipped[player] = 1 - vote
+            out.append([statement, dict(statement, votes=flipped)])
+        return out
+    if type == "mission":
+        return [[statement] + [dict(statement, fails=fails)
+                               for fails in range(len(statement["team"]) + 1)
+                               if fails != statement["fails"]]]
+    if type == "lady":
+        claim = statement["is good"]
+        return [[statement, dict(statement, **{"is good": not claim})]]
+    return []
+
+
+def model_likelihood(model, statement):
+    # What the statement's observation closure would return.
+    rnd = statement_round(statement)
+    type = statement["type"]
+    if type == "vote":
+        return model.votes(statement["team"], statement["votes"],
+                           statement["fails required"], rnd)
+    if type == "mission":
+        return model.mission(statement["team"], statement["fails"],
+                             statement["must fail"], rnd)
+    return model.player_sees_player_and_claims(
+        statement["p1"], statement["p2"], statement["is good"], rnd)
+
+
+def as_monomial(value):
+    if isinstance(value, Monomial):
+        return value
+    return Monomial(1.0 if value else 0.0)
+
+
+def game_terms(job):
+    # For every deal the game's rules allow, the Monomials of every
+    # decision's alternatives: {"deals": [[[(log coefficient, powers), ...],
+    # ...], ...]}, or the reason the game was left out.
+    path, max_deals = job
+    try:
+        game, _ = load_game(path)
+        model = game.model
+        names = sorted(model.parameters())
+        groups = [alternatives for statement in game.seen
+                  for alternatives in decisions(statement)]
+        if not groups:
+            return {"file": path, "skipped": "no decisions to fit"}
+        key = game.vector.key(False)
+        alive, _ = game.vector.possible(key, model.vectorized)
+        if not len(alive):
+            return {"file": path, "skipped": "no deal fits the game"}
+        if len(alive) > max_deals:
+            return {"file": path,
+                    "skipped": "%d possible deals; record the roles" %
+                    len(alive)}
+        game.deal_rows = game.vector.matrix(key).rows()
+        model.symbolic = dict((id(model.parameter(name)), k)
+                              for k, name in enumerate(names))
+        model.exact = True
+        deals = []
+        try:
+            for deal in alive.tolist():
+                model.set_deal(deal)
+                terms = []
+                for alternatives in groups:
+                    group = [as_monomial(model_likelihood(model, s))
+                             for s in alternatives]
+                    if not group[0]:
+                        break
+                    terms.append([(np.log(m.coefficient), m.powers)
+                                  for m in group if m])
+                else:
+                    deals.append(terms)
+        finally:
+            model.symbolic = None
+            model.exact = False
+        if not deals:
+            return {"file": path, "skipped": "no deal fits the game"}
+        return {"file": path, "names": names, "deals": deals}
+    except Exception, e:
+        return {"file": path, "error": "%s: %s" % (type(e).__name__, e)}
+
+
+def segment_logsumexp(x, starts):
+    # log(sum(exp(x))) over each run of x beginning at `starts`.
+    top = np.maximum.reduceat(x, starts)
+    lengths = np.diff(np.append(starts, len(x)))
+    shifted = np.exp(x - np.repeat(top, lengths))
+    return top + np.log(np.add.reduceat(shifted, starts))
+
+
+class Corpus(object):
+    # Every alternative of every decision of every possible deal of every
+    # game, as one row of powers. Rows are grouped by decision, decisions by
+    # deal and deals by game, each group contiguous.
+    def __init__(self, games, n_params):
+        coefficients = []
+        powers = []
+        group_starts = []
+        deal_starts = []
+        game_starts = []
+        for game in games:
+            game_starts.append(len(deal_starts))
+            for deal in game["deals"]:
+                deal_starts.append(len(group_starts))
+                for group in deal:
+                    group_starts.append(len(coefficients))
+                    for coefficient, monomial in group:
+                        coefficients.append(coefficient)
+                        powers.append(monomial)
+        self.n_games = len(games)
+        self.c = np.array(coefficients)
+        self.a = np.zeros((len(powers), n_params))
+        self.b = np.zeros((len(powers), n_params))
+        for row, monomial in enumerate(powers):
+            for k, (a, b) in monomial.items():
+                self.a[row, k] = a
+                self.b[row, k] = b
+        self.group_starts = np.array(group_starts, dtype=int)
+        self.deal_starts = np.array(deal_starts, dtype=int)
+        self.game_starts = np.array(game_starts, dtype=int)
+        self.group_sizes = np.diff(np.append(self.group_starts,
+                                             len(self.c)))
+        self.deal_sizes = np.diff(np.append(self.deal_starts,
+                                            len(self.group_starts)))
+        self.game_sizes = np.diff(np.append(self.game_starts,
+                                            len(self.deal_starts)))
+        self.observed = np.zeros(len(self.c), dtype=bool)
+        self.observed[self.group_starts] = True
+
+    def observations(self):
+        # How many decisions say something about each parameter, counted
+        # once per possible deal: those where some alternative has other
+        # powers of it than what was observed. (DefaultModel scores both
+        # outcomes of some decisions with the same chance(), which leaves
+        # that parameter where it started.)
+        a_seen = np.repeat(self.a[self.observed], self.group_sizes, axis=0)
+        b_seen = np.repeat(self.b[self.observed], self.group_sizes, axis=0)
+        differs = (self.a != a_seen) | (self.b != b_seen)
+        return np.maximum.reduceat(differs, self.group_starts).sum(axis=0)
+
+    def log_likelihood(self, p):
+        # The log-likelihood of the corpus at probabilities `p`, and its
+        # gradient with respect to logit(p).
+        log_p = np.log(p)
+        log_q = np.log1p(-p)
+        log_m = self.c + self.a.dot(log_p) + self.b.dot(log_q)
+        group_total = segment_logsumexp(log_m, self.group_starts)
+        decision = log_m[self.group_starts] - group_total
+        deal = np.add.reduceat(decision, self.deal_starts)
+        game = segment_logsumexp(deal, self.game_starts)
+        # d log_m / d logit(p) is a (1 - p) - b p, and each row counts
+        # with the weight of its deal in its game times (observed or not,
+        # minus its share of its decision).
+        deal_weight = np.exp(deal - np.repeat(game, self.game_sizes))
+        group_weight = np.repeat(deal_weight, self.deal_sizes)
+        share = np.exp(log_m - np.repeat(group_total, self.group_sizes))
+        row_weight = np.repeat(group_weight, self.group_sizes) * \
+            (self.observed - share)
+        gradient = row_weight.dot(self.a) * (1 - p) - \
+            row_weight.dot(self.b) * p
+        return game.sum(), gradient
+
+
+def objective(corpus, theta, prior, strength, free):
+    # Log-likelihood plus a Beta prior worth `strength` pseudo-observations
+    # centred on `prior`, both as functions of theta = logit(p).
+    p = 1.0 / (1.0 + np.exp(-theta))
+    ll, gradient = corpus.log_likelihood(p)
+    ll += strength * (prior * np.log(p) + (1 - prior) * np.log1p(-p)).sum()
+    gradient = (gradient + strength * (prior - p)) * free
+    return ll, gradient
+
+
+def optimize(corpus, start, strength, free, steps=500, tolerance=1e-6):
+    # Gradient ascent on logit(p) with a backtracking line search.
+    limit = np.log(1e6)
+    theta = np.clip(np.log(start / (1 - start)), -limit, limit)
+    ll, gradient = objective(corpus, theta, start, strength, free)
+    rate = 1.0
+    for step in range(steps):
+        if np.abs(gradient).max() < tolerance:
+            break
+        while rate > 1e-12:
+            candidate = np.clip(theta + rate * gradient, -limit, limit)
+            new_ll, new_gradient = objective(corpus, candidate, start,
+                                             strength, free)
+            if new_ll >= ll + 1e-4 * rate * gradient.dot(gradient):
+                break
+            rate /= 2
+        else:
+            break
+        improvement = new_ll - ll
+        theta, ll, gradient = candidate, new_ll, new_gradient
+        rate *= 2
+        if improvement < 1e-10:
+            break
+    return 1.0 / (1.0 + np.exp(-theta))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Fit the model's probabilities to finished games.")
+    parser.add_argument("paths", nargs="+",
+                        help=".gm files, or directories of them")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="games to prepare at once")
+    parser.add_argument("-o", "--output", default=None,
+                        help="write the fitted parameters to this JSON file")
+    parser.add_argument("--start", default=None,
+                        help="parameter file to start from (and shrink "
+                        "towards) instead of the model's defaults")
+    parser.add_argument("--only", default=None,
+                        help="comma-separated parameters to fit; the rest "
+                        "keep their starting values")
+    parser.add_argument("--strength", type=float, default=2.0,
+                        help="pseudo-observations pulling each parameter "
+                        "towards its starting value")
+    parser.add_argument("--max-deals", type=int, default=5000,
+                        help="skip games that this many deals could explain")
+    parser.add_argument("--steps", type=int, default=500,
+                        help="most optimizer steps to take")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    jobs = [(path, args.max_deals) for path in save_files(args.paths)]
+    pool = multiprocessing.Pool(max(1, args.jobs))
+    try:
+        results = pool.map(game_terms, jobs, chunksize=1)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    games = []
+    for result in results:
+        if "deals" in result:
+            games.append(result)
+        else:
+            sys.stderr.write("%s: %s\n" % (
+                result["file"], result.get("error") or result["skipped"]))
+    if not games:
+        sys.stderr.write("No games to fit.\n")
+        return 1
+    names = games[0]["names"]
+    model = load_game(games[0]["file"])[0].model
+    if args.start:
+        model.load_parameters(args.start)
+    start = np.array([model.parameters()[name] for name in names])
+    free = np.ones(len(names))
+    if args.only:
+        only = args.only.split(",")
+        for name in only:
+            model.parameter(name)
+        free = np.array([name in only for name in names], dtype=float)
+
+    corpus = Corpus(games, len(names))
+    before = corpus.log_likelihood(start)[0]
+    fitted = optimize(corpus, start, args.strength, free, args.steps)
+    after = corpus.log_likelihood(fitted)[0]
+    counts = corpus.observations()
+    print "%d games, %d possible deals" % (len(games),
+                                           len(corpus.deal_starts))
+    print "log-likelihood %.4f -> %.4f" % (before, after)
+    for k, name in enumerate(names):
+        print "%-28s %.3f -> %.3f  (%d decisions)" % (
+            name, start[k], fitted[k], counts[k])
+    if args.output:
+        model.set_parameters(dict((name, round(p, 6)) for name, p
+                                  in zip(names, fitted.tolist())))
+        model.save_parameters(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,44 @@
 from collections import defaultdict as dd
 import itertools
+import multiprocessing
 import progressbar
-import random
+import Queue
+import time
+
+from convergence import Convergence
+from deals import DealDeck, Trace, lancelots_flipped, team_mask
+from mcmc import CardTally, SwapSampler, MIN_STEPS_PER_SEAT
+from models.util import RandomStream
+from stats import ObservationStats, Profile
+from vector_evaluator import VectorEvaluator
+
+
+def parameter_grid(grid):
+    # {name: [values]} to the list of every combination, as overrides for
+    # DeceptionGame.sweep.
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[n] for n in names])]
+
+
+def blend(reports, weights=None):
+    # The mixture of several get_player_data-shaped reports, e.g. one per
+    # model from DeceptionGame.ensemble: equal parts unless `weights` says
+    # otherwise. Reports no deal fits are left out.
+    if weights is None:
+        weights = [1.0] * len(reports)
+    parts = [(w, report) for w, report in zip(weights, reports)
+             if w > 0 and report and report[0]["side"]]
+    total = float(sum(w for w, _ in parts))
+    out = [{"role": dd(float), "side": dd(float)}
+           for i in range(len(reports[0]))]
+    for w, report in parts:
+        for seat, player in zip(out, report):
+            for kind in ("role", "side"):
+                for value, p in player[kind].items():
+                    seat[kind][value] += p * w / total
+    return [{"role": dict(seat["role"]), "side": dict(seat["side"])}
+            for seat in out]
 
 
 def ResistanceGame(n_players):
@@ -19,44 +56,95 @@ def AvalonGame(n_players):
     return full_set[:n_players]
 
 
+def SavedGame(metadata):
+    # The cards a save file's game is dealt from: its "roles", a list of
+    # [role, is good] pairs, when it has them (custom role sets, more than
+    # 10 players), or else the Avalon set for its game_size.
+    if metadata.get("roles"):
+        return [(str(role), bool(good)) for role, good in metadata["roles"]]
+    return AvalonGame(int(metadata["game_size"]))
+
+
+def save_metadata(game, namemap):
+    # The first entry of a save file for `game`.
+    metadata = {"game_size": game.n_players, "player_names": namemap}
+    if game.player_array != AvalonGame(game.n_players):
+        metadata["roles"] = [list(card) for card in game.player_array]
+    return metadata
+
+
+# Team sizes per round, by number of players.
+MISSION_SIZES = {
+    5: [2, 3, 2, 3, 3],
+    6: [2, 3, 4, 3, 4],
+    7: [2, 3, 3, 4, 4],
+    8: [3, 4, 4, 5, 5],
+    9: [3, 4, 4, 5, 5],
+    10: [3, 4, 4, 5, 5],
+}
+
+
+def fails_required(n_players, round):
+    # The fourth mission needs two fails with seven or more players.
+    if round == 4 and n_players >= 7:
+        return 2
+    return 1
+
+
+# How long an adaptive eval may run when only a tolerance is given.
+DEFAULT_TIME_BUDGET = 60
+
+# How many deals the sampling loop checks between reorderings.
+REORDER_EVERY = 1024
+
+# The sampling loop times its checks on one deal in this many, and counts
+# each timing this many times over, rather than calling time.time() twice
+# per check.
+TIME_EVERY = 16
+
+
 class DeceptionGame(object):
     def __init__(self, player_array, model_class):
         self.player_array = player_array
         self.model = model_class(self)
-        self.all_permutations = list(set(itertools.permutations(player_array)))
-        self.quick_permutations = list(set(itertools.permutations(
-            [("", p[1]) for p in player_array])))
+        self.random = RandomStream()
+        self.all_permutations = DealDeck(player_array)
+        self.quick_permutations = DealDeck(
+            [("", p[1]) for p in player_array])
         self.n_players = len(player_array)
         self.n_good = len([x for x in player_array if x[1] is True])
         self.trace = None
+        self.errors = None
         self.observations = []
         self.seen = []
+        # tids[i] identifies observations[i]/seen[i] across disbelieves, so
+        # evaluators can cache per-observation results.
+        self.tids = []
         self.tid = 0
+        self.observation_stats = {}
         self.lancelots_switch_at = []
-
+        self.deal_rows = None
+        # (start, stop) when this game only evaluates part of the deck, as
+        # it does inside an eval worker process.
+        self.shard = None
+        self.vector = VectorEvaluator(self)
+
+    # Deals handed to the observations are row numbers in deal_rows, the
+    # DealRows of whichever deck is being evaluated.
     def player_is_good(self, deal, player, round):
-        if round is None:
-            return deal[player][1]
-        if self.player_role(deal, player) is not "GLance" and \
-           self.player_role(deal, player) is not "ELance":
-            return deal[player][1]
-        if len(self.lancelots_switch_at) == 0:
-            return deal[player][1]
-        if len(self.lancelots_switch_at) == 1:
-            if round >= self.lancelots_switch_at[0]:
-                return not deal[player][1]
-            else:
-                return deal[player][1]
-        if len(self.lancelots_switch_at) == 2:
-            if round >= self.lancelots_switch_at[0] and \
-               round < self.lancelots_switch_at[1]:
-                return not deal[player][1]
-            else:
-                return deal[player][1]
-        return deal[player][1]
+        flipped = lancelots_flipped(self.lancelots_switch_at, round)
+        return bool(self.deal_rows.good_mask(deal, flipped) >> player & 1)
 
     def player_role(self, deal, player):
-        return deal[player][0]
+        return self.deal_rows.role(deal, player)
+
+    def player_for_role(self, deal, role):
+        return self.deal_rows.seat_of(deal, role)
+
+    def spies_on_team(self, deal, team, round):
+        flipped = lancelots_flipped(self.lancelots_switch_at, round)
+        good = self.deal_rows.good_mask(deal, flipped)
+        return bin(team_mask(team) & ~good).count("1")
 
     def add_known_alliance(self, player_id, is_good):
         transaction = []
@@ -73,6 +161,7 @@ class DeceptionGame(object):
                           "is good": is_good,
                           "print_order": ["player",
                                           "is good"]})
+        self.tids.append(self.tid)
         self.tid += 1
 
     def switch_lancelots(self, round):
@@ -89,6 +178,7 @@ class DeceptionGame(object):
         self.seen.append({"type": "switch",
                           "round": rnd,
                           "print_order": ["round"]})
+        self.tids.append(self.tid)
         self.tid += 1
 
     def add_known_role(self, player_id, role_str):
@@ -106,6 +196,7 @@ class DeceptionGame(object):
                           "role": role_str,
                           "print_order": ["player",
                                           "role"]})
+        self.tids.append(self.tid)
         self.tid += 1
 
     def player_sees_player_and_claims(self, p1, p2, claim, round):
@@ -114,7 +205,9 @@ class DeceptionGame(object):
 
         def obs(deal):
             self.model.set_deal(deal)
-            return self.model.player_sees_player_and_claims(p1, p2, claim, rnd)
+            claims = self.model.timed(
+                self.model.player_sees_player_and_claims)
+            return claims(p1, p2, claim, rnd)
         transaction.append(obs)
         self.observations.append(transaction)
         self.seen.append({"type": "lady",
@@ -126,6 +219,7 @@ class DeceptionGame(object):
                                           "p2",
                                           "round",
                                           "is good"]})
+        self.tids.append(self.tid)
         self.tid += 1
 
     def do_mission(self, team, fails, must_fail, r):
@@ -134,7 +228,8 @@ class DeceptionGame(object):
 
         def obs(deal):
             self.model.set_deal(deal)
-            return self.model.mission(team, fails, must_fail, rnd)
+            mission = self.model.timed(self.model.mission)
+            return mission(team, fails, must_fail, rnd)
 
         transaction.append(obs)
         self.observations.append(transaction)
@@ -147,6 +242,7 @@ class DeceptionGame(object):
                                           "fails",
                                           "must fail",
                                           "round"]})
+        self.tids.append(self.tid)
         self.tid += 1
 
     def do_vote(self, team, votes, fail_req, r):
@@ -155,7 +251,8 @@ class DeceptionGame(object):
 
         def obs(deal):
             self.model.set_deal(deal)
-            return self.model.votes(team, votes, fail_req, rnd)
+            votes_on = self.model.timed(self.model.votes)
+            return votes_on(team, votes, fail_req, rnd)
 
         transaction.append(obs)
         self.observations.append(transaction)
@@ -165,6 +262,7 @@ class DeceptionGame(object):
                           "round": r,
                           "fails required": fail_req,
                           "print_order": ["team", "votes", "round"]})
+        self.tids.append(self.tid)
         self.tid += 1
 
     def load_save(self, input_list):
@@ -176,7 +274,8 @@ class DeceptionGame(object):
                              statement["fails required"],
                              statement["round"])
             if type == "switch":
-                self.switch_lancelots(statement["round"])
+                # Switches are saved with their 0-based round.
+                self.switch_lancelots(statement["round"] + 1)
             elif type == "mission":
                 self.do_mission(statement["team"],
                                 statement["fails"],
@@ -194,74 +293,291 @@ class DeceptionGame(object):
                 self.add_known_role(statement["player"],
                                     statement["role"])
 
-    def eval(self, length=10, quick=False):
-        random.seed()
-        if quick:
-            deck = self.quick_permutations[:]
+    def eval(self, length=10, quick=False, vectorized=None, exact=False,
+             workers=None, tolerance=None, time_budget=None, seed=None,
+             side_first=False, on_batch=None, stop=None, mcmc=None):
+        # Passing a tolerance and/or a time budget (in seconds) makes the
+        # sampling adaptive: batches of `length` iterations run until every
+        # player's side and top role are known to within +/- tolerance, or
+        # the time runs out.
+        #
+        # With a seed, sampling is repeatable draw for draw (for the same
+        # number of workers, and as long as no time budget cuts it short).
+        #
+        # side_first filters good/evil patterns with the alignment-only
+        # statements before scoring full role deals against the rest.
+        #
+        # on_batch(samples) is called after every sampled batch, with
+        # self.trace and self.errors covering the batches so far and
+        # `samples` the number of accepted samples. Once stop() returns
+        # True, sampling ends at the next batch (or, deal by deal, within
+        # REORDER_EVERY deals) and keeps what it has.
+        #
+        # With mcmc, the deck is never enumerated: a mcmc.SwapSampler's
+        # chains sample deals, and `length` counts their steps rather than
+        # passes over the deck (at least mcmc.MIN_STEPS_PER_SEAT per seat).
+        # It's the default for decks of more than
+        # vector_evaluator.ENUMERATE_UP_TO deals that the hard facts don't
+        # narrow down to that many.
+        self.random.seed(seed)
+        self.errors = None
+        if vectorized is None:
+            vectorized = self.model.vectorized
+        single = not (exact or quick or side_first or
+                      (workers is not None and workers > 1))
+        if mcmc is None:
+            mcmc = single and not self.vector.enumerable()
+        if mcmc and not single:
+            raise ValueError("MCMC only samples full deals, in one process")
+        parallel = workers is not None and workers > 1
+        if parallel and exact:
+            self.trace = self.parallel_eval(workers, length=length,
+                                            quick=quick,
+                                            vectorized=vectorized,
+                                            exact=exact,
+                                            side_first=side_first)
+            return
+        if (exact or side_first) and not vectorized and \
+           not self.model.supports_exact:
+            raise ValueError("%s can only be sampled" %
+                             type(self.model).__name__)
+        if exact:
+            self.trace = self.vector.exact(quick, vectorized, side_first)
+            return
+        adaptive = tolerance is not None or time_budget is not None
+        if adaptive:
+            if time_budget is None:
+                time_budget = DEFAULT_TIME_BUDGET
+            sizes = itertools.repeat(max(1, length))
         else:
-            deck = self.all_permutations[:]
-        new_deck = []
-        trace = {}
-        progress = progressbar.ProgressBar(
-            widgets=["Simulating games: ",
-                     progressbar.Bar(marker="*"),
-                     " ", progressbar.ETA()])
-        for i in progress(range(length)):
-            falses = 0
-            trues = 0
-            nones = 0
-            for deal in deck:
-                f_list = []
-                for obs in self.observations:
-                    for tid in obs:
-                        f_list.append(tid)
-                is_bad = False
-                dont_copy = False
-                for f in f_list:
-                    out = f(deal)
-                    if out is None:
-                        is_bad = True
-                        dont_copy = True
-                        nones += 1
+            if mcmc:
+                length = max(length, MIN_STEPS_PER_SEAT * self.n_players)
+            n = max(1, min(length, 10))
+            sizes = [length * (k + 1) // n - length * k // n
+                     for k in range(n)]
+            if self.shard is None and on_batch is None and \
+               not vectorized and not side_first and not mcmc and \
+               not parallel:
+                progress = progressbar.ProgressBar(
+                    widgets=["Simulating games: ",
+                             progressbar.Bar(marker="*"),
+                             " ", progressbar.ETA()])
+                sizes = progress(sizes)
+        convergence = Convergence(self.n_players)
+        if mcmc:
+            sampler = SwapSampler(self, vectorized=vectorized)
+            trace = CardTally(self.all_permutations)
+            batches = sampler.batches(sizes, stop)
+        elif parallel:
+            trace = Trace(self.vector.matrix(self.vector.key(quick)))
+            batches = self.parallel_batches(
+                workers, None if adaptive else sizes, length, quick,
+                vectorized, side_first, stop, reorder=seed is None)
+        else:
+            trace = Trace(self.vector.matrix(self.vector.key(quick)))
+            batches = self.sample_batches(sizes, quick, vectorized,
+                                          side_first, stop,
+                                          reorder=seed is None)
+        self.trace = trace
+        started = time.time()
+        try:
+            for batch in batches:
+                trace.add(batch)
+                convergence.add(batch)
+                if on_batch is not None:
+                    self.errors = convergence.errors()
+                    on_batch(convergence.samples())
+                if stop is not None and stop():
+                    break
+                if adaptive:
+                    if tolerance is not None and \
+                       convergence.converged(tolerance):
                         break
-                    if out is True:
-                        trues += 1
-                        continue
-                    if out is False:
-                        is_bad = True
-                        falses += 1
+                    if time.time() - started > time_budget:
                         break
-                if not is_bad:
-                    if deal not in trace:
-                        trace[deal] = 1
-                    trace[deal] += 1
-                if not dont_copy:
-                    new_deck.append(deal)
-            deck = new_deck
-            new_deck = []
-
-        self.trace = trace
+        finally:
+            # Stops the workers of a parallel eval.
+            batches.close()
+        self.errors = convergence.errors()
+
+    def sample_batches(self, sizes, quick=False, vectorized=False,
+                       side_first=False, stop=None, reorder=True):
+        # Yields one Trace per batch size, each from that many passes over
+        # the deck. Without reorder, the checks keep the order they were
+        # declared in: which checks run decides which draws a deal takes
+        # from the random stream, so a seeded eval can't let timings order
+        # them.
+        if vectorized or side_first:
+            for size in sizes:
+                yield self.vector.sample(size, quick, vectorized, side_first)
+            return
+        # The first pass walks the whole deck; later passes only revisit the
+        # deals that weren't ruled impossible.
+        matrix = self.vector.matrix(self.vector.key(quick))
+        self.deal_rows = matrix.rows()
+        deck = range(len(matrix))
+        new_deck = []
+        checks = self.ordered_checks(reorder)
+        for size in sizes:
+            trace = {}
+            for i in range(size):
+                for n, deal in enumerate(deck):
+                    if n % REORDER_EVERY == REORDER_EVERY - 1:
+                        if stop is not None and stop():
+                            return
+                        checks = self.ordered_checks(reorder)
+                    is_bad = False
+                    dont_copy = False
+                    timed = n % TIME_EVERY == 0
+                    for f, stats in checks:
+                        if timed:
+                            started = time.time()
+                            out = f(deal)
+                            stats.seconds += (time.time() - started) * \
+                                TIME_EVERY
+                        else:
+                            out = f(deal)
+                        stats.calls += 1
+                        if out is None:
+                            is_bad = True
+                            dont_copy = True
+                            stats.nones += 1
+                            break
+                        if out is True:
+                            stats.trues += 1
+                            continue
+                        if out is False:
+                            is_bad = True
+                            stats.falses += 1
+                            break
+                    if not is_bad:
+                        if deal not in trace:
+                            trace[deal] = 0
+                        trace[deal] += 1
+                    if not dont_copy:
+                        new_deck.append(deal)
+                deck = new_deck
+                new_deck = []
+            batch = Trace(matrix)
+            batch.counts[list(trace)] = list(trace.values())
+            yield batch
+
+    def ordered_checks(self, reorder=True):
+        # Every observation closure paired with its running stats, cheapest
+        # expected cost per rejected deal first (or in declaration order,
+        # without reorder). A deal only counts if every check passes, so the
+        # order can't change the posterior; it just lets cheap, selective
+        # checks (known roles, say) turn deals away before the expensive
+        # vote checks run.
+        checks = []
+        for tid, obs in zip(self.tids, self.observations):
+            if tid not in self.observation_stats:
+                self.observation_stats[tid] = ObservationStats()
+            stats = self.observation_stats[tid]
+            for f in obs:
+                cost = stats.cost_per_rejection() if reorder else 0.0
+                checks.append((cost, len(checks), f, stats))
+        checks.sort()
+        return [(f, stats) for _, _, f, stats in checks]
+
+    def parallel_batches(self, workers, sizes, length, quick=False,
+                         vectorized=False, side_first=False, stop=None,
+                         reorder=True):
+        # Like sample_batches, with the deck split into one contiguous range
+        # per worker process (see parallel_eval). Each worker samples its
+        # range batch by batch and sends back what every batch accepted;
+        # the k-th batches of all the ranges together make one batch over
+        # the whole deck. `sizes` is None for batches of `length` until
+        # told to stop. Closing the generator stops the workers.
+        matrix = self.vector.matrix(self.vector.key(quick))
+        size = len(matrix)
+        bounds = [size * k // workers for k in range(workers + 1)]
+        base_seed = self.random.state.randint(1 << 30)
+        results = multiprocessing.Queue()
+        stopped = multiprocessing.Event()
+        processes = []
+        for k in range(workers):
+            job = (self.player_array, type(self.model),
+                   self.model.parameters(), self.seen,
+                   (bounds[k], bounds[k + 1]), base_seed + k,
+                   (sizes, length, quick, vectorized, side_first, reorder))
+            process = multiprocessing.Process(
+                target=_sample_shard, args=(k, job, results, stopped))
+            process.daemon = True
+            processes.append(process)
+        pending = [[] for _ in range(workers)]
+        finished = set()
+        try:
+            for process in processes:
+                process.start()
+            while True:
+                if all(pending):
+                    batch = Trace(matrix)
+                    for shard in pending:
+                        rows, counts = shard.pop(0)
+                        batch.counts[rows] += counts
+                    yield batch
+                    continue
+                if any(not pending[k] for k in finished):
+                    return
+                if stop is not None and stop():
+                    return
+                try:
+                    k, rows, counts = results.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if rows is None:
+                    if counts is not None:
+                        raise ValueError(counts)
+                    finished.add(k)
+                else:
+                    pending[k].append((rows, counts))
+        finally:
+            stopped.set()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+    def parallel_eval(self, workers, **kwargs):
+        # Splits the deck into one contiguous range per worker. Each worker
+        # rebuilds the game from self.seen (closures don't pickle), evaluates
+        # its range and sends back the deals it accepted; shards never share
+        # a deal.
+        quick = bool(kwargs.get("quick"))
+        matrix = self.vector.matrix(self.vector.key(quick))
+        size = len(matrix)
+        bounds = [size * k // workers for k in range(workers + 1)]
+        base_seed = self.random.state.randint(1 << 30)
+        jobs = [(self.player_array, type(self.model),
+                 self.model.parameters(), self.seen,
+                 (bounds[k], bounds[k + 1]),
+                 dict(kwargs, seed=base_seed + k))
+                for k in range(workers)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_eval_shard, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        trace = Trace(matrix)
+        for rows, counts in results:
+            trace.counts[rows] = counts
+        return trace
 
     def report(self):
         return self.get_player_data()
 
+    def get_player_errors(self):
+        # 95% confidence half-widths for get_player_data(), from the last
+        # sampled eval; None after an exact one.
+        return self.errors
+
     def get_player_data(self):
-        out = []
-        for i in range(self.n_players):
-            out.append({})
-            out[i]["role"] = dd(float)
-            out[i]["side"] = dd(float)
-
-        size = sum(self.trace.values()) * 1.0
-        for deal, score in self.trace.items():
-            for i, card in enumerate(deal):
-                role, side = card
-                out[i]["role"][role] += (score * 1.0) / size
-                out[i]["side"][side] += (score * 1.0) / size
-        for i in range(self.n_players):
-            out[i]["role"] = dict(out[i]["role"])
-            out[i]["side"] = dict(out[i]["side"])
-        return out
+        # For each player, the chance of each side and each role.
+        if not self.trace:
+            return [{"role": {}, "side": {}} for i in range(self.n_players)]
+        return self.trace.marginals()
 
     def _aggregate(self, l, i):
         out = dd(float)
@@ -274,7 +590,161 @@ class DeceptionGame(object):
         return "%d Player Game (%d constraints)" % (self.n_players,
                                                     len(self.seen))
 
+    def set_parameters(self, values):
+        # Changes the model's probabilities ({name: probability}, see
+        # BaseModel.parameters); cached results that used the old ones are
+        # dropped.
+        self.model.set_parameters(values)
+        self.vector.forget_model_columns()
+
+    def sweep(self, settings, quick=False, vectorized=None):
+        # Exact per-player posteriors (get_player_data's shape) under each
+        # of `settings`, dicts of parameter overrides; see parameter_grid.
+        # The model's own parameters are left as they were.
+        if vectorized is None:
+            vectorized = self.model.vectorized
+        if not vectorized and not self.model.supports_exact:
+            raise ValueError("%s can only be sampled" %
+                             type(self.model).__name__)
+        out = []
+        for trace in self.vector.sweep(settings, quick, vectorized):
+            if trace:
+                out.append(trace.marginals())
+            else:
+                out.append([{"role": {}, "side": {}}
+                            for i in range(self.n_players)])
+        return out
+
+    def ensemble(self, model_classes, quick=False, vectorized=None):
+        # Exact per-player posteriors (get_player_data's shape) under each
+        # of `model_classes`, from one deck and one pass of the known sides
+        # and roles. The game's own class is evaluated with self.model, so
+        # it keeps any parameters that were set; see blend() to mix them.
+        models = []
+        flags = []
+        for model_class in model_classes:
+            if type(self.model) is model_class:
+                model = self.model
+            else:
+                model = model_class(self)
+            flag = model.vectorized if vectorized is None else vectorized
+            if not flag and not model.supports_exact:
+                raise ValueError("%s can only be sampled" %
+                                 model_class.__name__)
+            models.append(model)
+            flags.append(flag)
+        out = []
+        for trace in self.vector.ensemble(models, quick, flags):
+            if trace:
+                out.append(trace.marginals())
+            else:
+                out.append([{"role": {}, "side": {}}
+                            for i in range(self.n_players)])
+        return out
+
+    def timeline(self, quick=False, vectorized=None):
+        # Exact per-player posteriors (get_player_data's shape) with none of
+        # the statements, then after each of game.seen in turn.
+        if vectorized is None:
+            vectorized = self.model.vectorized
+        if not vectorized and not self.model.supports_exact:
+            raise ValueError("%s can only be sampled" %
+                             type(self.model).__name__)
+        out = []
+        for trace in self.vector.timeline(quick, vectorized):
+            if trace:
+                out.append(trace.marginals())
+            else:
+                out.append([{"role": {}, "side": {}}
+                            for i in range(self.n_players)])
+        return out
+
+    def copy(self):
+        # A separate game with the same players, model and statements, that
+        # can be evaluated (in another thread, say) without touching this
+        # one.
+        game = DeceptionGame(self.player_array, type(self.model))
+        game.model.set_parameters(self.model.parameters())
+        game.load_save(self.seen)
+        if self.model.profile is not None:
+            game.profile()
+        return game
+
+    def profile(self, on=True):
+        # Starts (or stops) timing the model's functions; see get_stats.
+        if on:
+            self.model.profile = Profile()
+        else:
+            self.model.profile = None
+
+    def reset_stats(self):
+        self.observation_stats = {}
+        self.vector.stats = {}
+        if self.model.profile is not None:
+            self.model.profile = Profile()
+
+    def get_stats(self):
+        # What evaluating each observation has cost so far, per evaluator
+        # that ran it (the sampling loop, or the vectorized one), and the
+        # calls and time per model function while profiling. Stats from
+        # parallel eval workers stay in the workers.
+        observations = []
+        for i, (tid, statement) in enumerate(zip(self.tids, self.seen)):
+            for evaluator, stats in (("sampled", self.observation_stats),
+                                     ("vectorized", self.vector.stats)):
+                if tid in stats:
+                    row = stats[tid].as_dict()
+                    row.update({"index": i,
+                                "type": statement["type"],
+                                "evaluator": evaluator})
+                    observations.append(row)
+        model = None
+        if self.model.profile is not None:
+            model = self.model.profile.as_dict()
+        return {"observations": observations, "model": model}
+
     def disbelieve(self, i):
         self.observations = self.observations[:i] + self.observations[i + 1:]
         self.seen = self.seen[:i] + self.seen[i + 1:]
-        self.trace = {}
+        self.observation_stats.pop(self.tids[i], None)
+        self.vector.stats.pop(self.tids[i], None)
+        self.tids = self.tids[:i] + self.tids[i + 1:]
+        self.lancelots_switch_at = [s["round"] for s in self.seen
+                                    if s["type"] == "switch"]
+        self.trace = None
+
+
+def _eval_shard(job):
+    player_array, model_class, parameters, seen, shard, kwargs = job
+    game = DeceptionGame(player_array, model_class)
+    game.model.set_parameters(parameters)
+    game.load_save(seen)
+    game.shard = shard
+    game.eval(**kwargs)
+    rows, counts = game.trace.sparse()
+    return rows + shard[0], counts
+
+
+def _sample_shard(k, job, results, stopped):
+    # A parallel_batches worker: sends (k, rows, counts) for every batch of
+    # its range, then (k, None, None) -- or (k, None, error) if it failed.
+    try:
+        player_array, model_class, parameters, seen, shard, seed, args = job
+        sizes, length, quick, vectorized, side_first, reorder = args
+        if sizes is None:
+            sizes = itertools.repeat(max(1, length))
+        game = DeceptionGame(player_array, model_class)
+        game.model.set_parameters(parameters)
+        game.load_save(seen)
+        game.shard = shard
+        game.random.seed(seed)
+        for batch in game.sample_batches(sizes, quick, vectorized,
+                                         side_first, stopped.is_set,
+                                         reorder):
+            rows, counts = batch.sparse()
+            results.put((k, rows + shard[0], counts))
+            if stopped.is_set():
+                break
+        results.put((k, None, None))
+    except Exception, e:
+        results.put((k, None, "%s: %s" % (type(e).__name__, e)))
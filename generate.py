@@ -0,0 +1,240 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+from deals import DealMatrix
+from game_evaluator import DeceptionGame, AvalonGame, ResistanceGame, \
+    MISSION_SIZES, fails_required
+from models.default_model import DefaultModel, default_vote, special_votes
+
+
+# Plays out synthetic games with known roles, for benchmarking and
+# calibrating the evaluator, e.g.
+#
+#   python generate.py 10000 --players 10 --lady -j 8 -o synthetic/
+#
+# Each game deals a random hand and plays it forward with the model's
+# behaviours: every vote, mission result and Lady claim is drawn from the
+# likelihoods DefaultModel gives its alternatives, normalized over them the
+# way fit.py scores decisions. Leaders take themselves and a random rest of
+# the team (the model has nothing to say about proposals), and redraw a team
+# the model couldn't see anyone vote on, so every game it writes is one the
+# evaluator can explain.
+#
+# Games go to a directory of .gm files, or to stdout as JSON Lines (one save
+# file's list per line). The true roles are in the first entry, under
+# "truth"; --reveal also adds them as known_role statements, which is what
+# fit.py wants.
+
+# Times a leader redraws a team before the game is given up on.
+MAX_REDRAWS = 100
+
+# Avalon's Lancelot variant: one of these is turned over at the start of
+# rounds 3, 4 and 5, and each True switches the Lancelots.
+SWITCH_CARDS = [True, True, False, False, False]
+
+
+def draw(rng, weights):
+    # An index drawn in proportion to `weights`, or None if they're all 0.
+    weights = np.array([float(w or 0.0) for w in weights])
+    total = weights.sum()
+    if total <= 0:
+        return None
+    return int(np.searchsorted(np.cumsum(weights), rng.random_sample() *
+                               total, side="right"))
+
+
+class Player(object):
+    # Plays one dealt game with a model, recording it on a DeceptionGame.
+    def __init__(self, player_array, rng, parameters=None):
+        self.rng = rng
+        self.game = DeceptionGame(player_array, DefaultModel)
+        if parameters:
+            self.game.set_parameters(parameters)
+        deck = self.game.all_permutations
+        cards = np.repeat(np.arange(len(deck.cards)), deck.counts)
+        cards = rng.permutation(cards)
+        self.game.deal_rows = DealMatrix.from_cards(deck,
+                                                    cards[None, :]).rows()
+        self.model = self.game.model
+        self.model.exact = True
+        self.model.set_deal(0)
+        self.roles = [deck.cards[c] for c in cards]
+
+    def vote(self, team, fail_req, rnd):
+        # Everyone's vote, or None if someone could vote neither way.
+        votes = [0] * self.game.n_players
+        for player in range(self.game.n_players):
+            f = special_votes.get(self.model.player_role(player),
+                                  default_vote)
+            choices = []
+            for vote in (0, 1):
+                votes[player] = vote
+                choices.append(f(self.model, player, team, votes, fail_req,
+                                 rnd))
+            votes[player] = draw(self.rng, choices)
+            if votes[player] is None:
+                return None
+        return votes
+
+    def propose(self, leader, size, fail_req, rnd):
+        others = [p for p in range(self.game.n_players) if p != leader]
+        for _ in range(MAX_REDRAWS):
+            team = sorted([leader] + list(
+                self.rng.choice(others, size - 1, replace=False)))
+            team = [int(p) for p in team]
+            votes = self.vote(team, fail_req, rnd)
+            if votes is None:
+                continue
+            fails = draw(self.rng, [
+                self.model.mission(team, fails, False, rnd)
+                for fails in range(size + 1)])
+            if fails is not None:
+                return team, votes, fails
+        raise ValueError("No team the model can explain")
+
+    def lady(self, holder, target, round):
+        claims = [self.model.player_sees_player_and_claims(
+            holder, target, claim, round - 1) for claim in (True, False)]
+        return draw(self.rng, claims) == 0
+
+    def play(self, lady=False, switches=False):
+        game = self.game
+        n_players = game.n_players
+        sizes = MISSION_SIZES[n_players]
+        leader = 0
+        holder = n_players - 1
+        held = set([holder])
+        switch_cards = list(self.rng.permutation(SWITCH_CARDS))
+        passed = failed = 0
+        for round in range(1, 6):
+            if switches and round >= 3 and switch_cards.pop():
+                game.switch_lancelots(round)
+            fail_req = fails_required(n_players, round)
+            for proposal in range(5):
+                team, votes, fails = self.propose(
+                    leader, sizes[round - 1], fail_req, round - 1)
+                leader = (leader + 1) % n_players
+                game.do_vote(team, votes, fail_req, round)
+                if sum(votes) * 2 > n_players:
+                    break
+            else:
+                # Five rejected teams in a row: evil wins.
+                return "evil"
+            game.do_mission(team, fails, False, round)
+            if fails >= fail_req:
+                failed += 1
+            else:
+                passed += 1
+            if passed == 3:
+                return "good"
+            if failed == 3:
+                return "evil"
+            if lady and 2 <= round <= 4:
+                target = int(self.rng.choice(
+                    [p for p in range(n_players) if p not in held]))
+                game.player_sees_player_and_claims(
+                    holder, target, self.lady(holder, target, round), round)
+                holder = target
+                held.add(holder)
+
+
+def generate_one(job):
+    # One game as the list a save file holds.
+    n_players, seed, options = job
+    rng = np.random.RandomState(seed)
+    if options["resistance"]:
+        player_array = ResistanceGame(n_players)
+    else:
+        player_array = AvalonGame(n_players)
+    player = Player(player_array, rng, options["parameters"])
+    roles = set(role for role, _ in player_array)
+    switches = options["switches"] and "GLance" in roles and \
+        "ELance" in roles
+    winner = player.play(options["lady"], switches)
+    game = player.game
+    if options["reveal"]:
+        for seat, (role, _) in enumerate(player.roles):
+            game.add_known_role(seat, role)
+    metadata = {"game_size": n_players,
+                "player_names": {},
+                "seed": seed,
+                "truth": [role for role, _ in player.roles],
+                "winner": winner}
+    if player_array != AvalonGame(n_players):
+        metadata["roles"] = [list(card) for card in player_array]
+    return [metadata] + game.seen
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Play out synthetic games with known roles.")
+    parser.add_argument("count", type=int, help="how many games")
+    parser.add_argument("--players", default="10",
+                        help="comma-separated game sizes to cycle through")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="games to play at once")
+    parser.add_argument("-o", "--output", default=None,
+                        help="directory for the .gm files; JSON Lines on "
+                        "stdout without it")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="game k is played with seed + k")
+    parser.add_argument("--params", default=None,
+                        help="JSON file of model probabilities to play with")
+    parser.add_argument("--resistance", action="store_true",
+                        help="deal Resistance rather than Avalon roles")
+    parser.add_argument("--lady", action="store_true",
+                        help="use the Lady of the Lake after rounds 2-4")
+    parser.add_argument("--switches", action="store_true",
+                        help="turn over Lancelot switch cards from round 3")
+    parser.add_argument("--reveal", action="store_true",
+                        help="end every game with known_role statements")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    sizes = [int(n) for n in args.players.split(",") if n]
+    for n in sizes:
+        if n not in MISSION_SIZES:
+            sys.stderr.write("No mission sizes for %d players\n" % n)
+            return 1
+    parameters = None
+    if args.params:
+        with open(args.params, "r") as infile:
+            parameters = json.load(infile)
+    options = {"parameters": parameters,
+               "resistance": args.resistance,
+               "lady": args.lady,
+               "switches": args.switches,
+               "reveal": args.reveal}
+    jobs = [(sizes[k % len(sizes)], args.seed + k, options)
+            for k in range(args.count)]
+    if args.output and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    pool = multiprocessing.Pool(max(1, args.jobs))
+    try:
+        for k, save in enumerate(pool.imap(generate_one, jobs,
+                                           chunksize=16)):
+            if args.output:
+                path = os.path.join(args.output, "game%06d.gm" % k)
+                with open(path, "w") as outfile:
+                    json.dump(save, outfile, indent=2)
+            else:
+                sys.stdout.write(json.dumps(save) + "\n")
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,202 @@
+import numpy as np
+
+from deals import DealMatrix, Trace
+
+
+# Chains run side by side; each step is one vectorized pass over them.
+DEFAULT_CHAINS = 256
+
+# Steps every chain takes, once they all fit the statements, before any is
+# counted.
+MIN_BURN_IN = 200
+
+# Steps every chain takes after the burn-in, per seat, at the least: with
+# fewer the chains don't mix, and the error bars come out too small.
+MIN_STEPS_PER_SEAT = 50
+
+# How many steps the chains get to find deals that fit at all.
+MAX_SEARCH = 5000
+
+# While searching, how strongly a chain prefers breaking fewer statements.
+SEARCH_TEMPERATURE = 2.0
+
+
+class CardTally(Trace):
+    # A Trace of sampled rather than enumerated deals: how many samples
+    # dealt each seat each card, so its size doesn't depend on the deck's.
+    # There's no DealMatrix behind it, so no deals to list either.
+    def __init__(self, deck):
+        super(CardTally, self).__init__(
+            None, np.zeros((deck.n_players, len(deck.cards))))
+        self.deck = deck
+        self.samples = 0.0
+
+    def __len__(self):
+        return int(self.samples)
+
+    def add(self, other):
+        self.counts += other.counts
+        self.samples += other.samples
+
+    def record(self, cards):
+        # `cards` is a [deals, seats] array of indices into deck.cards.
+        n_players, n_cards = self.counts.shape
+        seats = np.arange(n_players)
+        self.counts += np.bincount(
+            (cards + n_cards * seats).ravel(),
+            minlength=n_players * n_cards).reshape(n_players, n_cards)
+        self.samples += len(cards)
+
+    def total(self):
+        return self.samples
+
+    def sparse(self):
+        raise ValueError("An MCMC tally only counts cards per seat; it "
+                         "has no deals")
+
+    def tallies(self):
+        out = []
+        for p in range(self.deck.n_players):
+            roles = {}
+            sides = {}
+            for c, (role, good) in enumerate(self.deck.cards):
+                n = float(self.counts[p, c])
+                if n > 0:
+                    roles[role] = roles.get(role, 0.0) + n
+                    sides[good] = sides.get(good, 0.0) + n
+            out.append({"role": roles, "side": sides})
+        return out
+
+
+class SwapSampler(object):
+    # Samples deals in proportion to how likely they make the game's
+    # statements, without enumerating the deck, so it works for custom
+    # role lists and more than 10 players (up to 32).
+    #
+    # Each chain holds one deal. A step proposes swapping the cards of two
+    # seats that hold different ones, and accepts with the Metropolis rule;
+    # the proposal is symmetric, so the chains settle on the same posterior
+    # the exact evaluator computes. The chains' deals are a small
+    # DealMatrix, so the statements are scored exactly the way the
+    # vectorized evaluator (or the observation closures) scores them.
+    #
+    # Chains start from random deals and first search for ones that fit,
+    # preferring swaps that break fewer statements, then burn in.
+    def __init__(self, game, chains=DEFAULT_CHAINS, vectorized=None,
+                 burn_in=None):
+        self.game = game
+        self.deck = game.all_permutations
+        if vectorized is None:
+            vectorized = game.model.vectorized
+        if not vectorized and not game.model.supports_exact:
+            raise ValueError("%s can only be sampled" %
+                             type(game.model).__name__)
+        self.vectorized = vectorized
+        self.n_chains = chains
+        if burn_in is None:
+            burn_in = max(MIN_BURN_IN, 20 * self.deck.n_players)
+        self.burn_in = burn_in
+        self.cards = None
+        self.weights = None
+        self.broken = None
+        self.proposed = 0
+        self.accepted = 0
+
+    def score(self, cards):
+        # For each deal: the product of the statements' likelihoods, and
+        # how many statements rule it out.
+        matrix = DealMatrix.from_cards(self.deck, cards)
+        deals = matrix.view(np.arange(len(cards)),
+                            self.game.lancelots_switch_at)
+        weights = np.ones(len(cards))
+        broken = np.zeros(len(cards), dtype=int)
+        for statement, obs in zip(self.game.seen, self.game.observations):
+            column = self.game.vector.likelihood(
+                statement, deals, None if self.vectorized else obs)
+            broken += column <= 0
+            weights *= column
+        return weights, broken
+
+    def propose(self, cards):
+        # Swaps two seats with different cards, in every chain.
+        rng = self.game.random.state
+        chains = np.arange(len(cards))
+        n_players = cards.shape[1]
+        i = rng.randint(n_players, size=len(cards))
+        j = rng.randint(n_players, size=len(cards))
+        same = cards[chains, i] == cards[chains, j]
+        while same.any():
+            i[same] = rng.randint(n_players, size=same.sum())
+            j[same] = rng.randint(n_players, size=same.sum())
+            same = cards[chains, i] == cards[chains, j]
+        proposal = cards.copy()
+        proposal[chains, i] = cards[chains, j]
+        proposal[chains, j] = cards[chains, i]
+        return proposal
+
+    def step(self):
+        if len(self.deck.cards) < 2:
+            return
+        rng = self.game.random.state
+        proposal = self.propose(self.cards)
+        weights, broken = self.score(proposal)
+        u = rng.random_sample(len(proposal))
+        fits = self.broken == 0
+        accept = np.where(
+            fits, u * self.weights < weights,
+            u < np.exp(SEARCH_TEMPERATURE * (self.broken - broken)))
+        self.cards[accept] = proposal[accept]
+        self.weights[accept] = weights[accept]
+        self.broken[accept] = broken[accept]
+        self.proposed += int(fits.sum())
+        self.accepted += int((accept & fits).sum())
+
+    def start(self, stop=None):
+        rng = self.game.random.state
+        cards = np.repeat(np.arange(len(self.deck.cards)),
+                          self.deck.counts).astype(np.int8)
+        self.cards = np.array([rng.permutation(cards)
+                               for _ in range(self.n_chains)])
+        self.weights, self.broken = self.score(self.cards)
+        for _ in range(MAX_SEARCH):
+            if not self.broken.any():
+                break
+            if stop is not None and stop():
+                return False
+            self.step()
+        fits = np.nonzero(self.broken == 0)[0]
+        if not len(fits):
+            raise ValueError("Couldn't find a deal that fits the "
+                             "statements")
+        # Chains still stuck restart from one that made it; the burn-in
+        # spreads them out again.
+        stuck = np.nonzero(self.broken)[0]
+        copies = fits[rng.randint(len(fits), size=len(stuck))]
+        self.cards[stuck] = self.cards[copies]
+        self.weights[stuck] = self.weights[copies]
+        self.broken[stuck] = 0
+        for _ in range(self.burn_in):
+            if stop is not None and stop():
+                return False
+            self.step()
+        return True
+
+    def batches(self, sizes, stop=None):
+        # Yields a CardTally per batch size, of that many steps of every
+        # chain.
+        if not self.start(stop):
+            return
+        for size in sizes:
+            tally = CardTally(self.deck)
+            for _ in range(size):
+                if stop is not None and stop():
+                    break
+                self.step()
+                tally.record(self.cards)
+            yield tally
+
+    def acceptance(self):
+        # The share of proposed swaps the fitted chains took.
+        if not self.proposed:
+            return None
+        return self.accepted / float(self.proposed)
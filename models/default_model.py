@@ -1,4 +1,7 @@
-from util import Bernoulli
+import json
+import numpy as np
+
+from util import Bernoulli, Monomial
 
 
 # Models work like this; feel free to inherit from BaseModel to get the
@@ -20,16 +23,47 @@ from util import Bernoulli
 #
 # * None -- This set of statements could NEVER happen, please remove them from
 #   consideration.
+#
+# Make random decisions through self.chance(bernoulli) and
+# self.chance_not(bernoulli) rather than calling bernoulli.rand(), and set
+# `supports_exact = True`. When the game evaluates exactly, those helpers hand
+# back the probability instead of a coin flip, so the calls above return the
+# likelihood of the statement (a float, 0 for impossible) and each deal is
+# weighted in a single pass. Models that sample directly still work, but only
+# through the sampling evaluator.
+#
+# Models can also set `vectorized = True` and provide vec_votes, vec_mission
+# and vec_player_sees_player_and_claims. These take a deals.DealView (many
+# deals at once) and return, for each deal, the probability that the calls
+# above would return True -- 0 standing in for None. DeceptionGame.eval then
+# scores the whole deck with array operations instead of one deal at a time.
 
 class BaseModel(object):
+    vectorized = False
+    supports_exact = False
+
     def __init__(self, game):
         self.game = game
         self.deal = []
+        self.exact = False
+        # A stats.Profile while the game is profiling model functions.
+        self.profile = None
+        # While fitting, {id(bernoulli): parameter index}; chance() and
+        # chance_not() then return util.Monomials.
+        self.symbolic = None
 
 #  These are helper functions -- do not override
+#  The evaluators hand set_deal a deal's row number in game.deal_rows, not a
+#  tuple of (role, is good) per seat as they used to. It only means anything
+#  to the helpers below, and only while deal_rows is the matrix being
+#  evaluated. Models that read the deal themselves should call cards() for
+#  the old tuple.
     def set_deal(self, deal):
         self.deal = deal
 
+    def cards(self):
+        return self.game.deal_rows.matrix.deal(self.deal)
+
     def is_good(self, player, round):
         return self.game.player_is_good(self.deal, player, round)
 
@@ -40,11 +74,72 @@ class BaseModel(object):
         return self.game.player_role(self.deal, player)
 
     def get_id_for_role(self, role):
-        roles = [x[0] for x in self.deal]
-        try:
-            return roles.index(role)
-        except Exception:
-            return -1
+        return self.game.player_for_role(self.deal, role)
+
+    def n_spies(self, team, round):
+        return self.game.spies_on_team(self.deal, team, round)
+
+    def timed(self, f):
+        # Call model functions through this (self.timed(f)(args)) to have
+        # them show up in the game's profile.
+        if self.profile is None:
+            return f
+        return self.profile.wrap(f)
+
+    def chance(self, bernoulli):
+        if self.symbolic is not None:
+            return Monomial(1.0, {self.symbolic[id(bernoulli)]: (1, 0)})
+        if self.exact:
+            return bernoulli.percentage
+        return bernoulli.rand(self.game.random)
+
+    def chance_not(self, bernoulli):
+        if self.symbolic is not None:
+            return Monomial(1.0, {self.symbolic[id(bernoulli)]: (0, 1)})
+        if self.exact:
+            return 1.0 - bernoulli.percentage
+        return not bernoulli.rand(self.game.random)
+
+#  Every Bernoulli attribute (or list of them) is a parameter, named like
+#  "lady_will_duck" or "ignorance_on_round[2]".
+    def parameters(self):
+        out = {}
+        for name, value in vars(self).items():
+            if isinstance(value, Bernoulli):
+                out[name] = value.percentage
+            elif isinstance(value, list):
+                for i, b in enumerate(value):
+                    if isinstance(b, Bernoulli):
+                        out["%s[%d]" % (name, i)] = b.percentage
+        return out
+
+    def parameter(self, name):
+        attr, _, index = name.partition("[")
+        value = getattr(self, attr, None)
+        if index and isinstance(value, list):
+            try:
+                value = value[int(index.rstrip("]"))]
+            except (ValueError, IndexError):
+                value = None
+        if not isinstance(value, Bernoulli):
+            raise KeyError("No model parameter named %s" % name)
+        return value
+
+    def set_parameters(self, values):
+        for name, p in values.items():
+            self.parameter(name).percentage = float(p)
+
+    def load_parameters(self, path):
+        # A JSON {name: probability} file, as written by save_parameters
+        # or fit.py. Returns what was read.
+        with open(path) as infile:
+            values = json.load(infile)
+        self.set_parameters(values)
+        return values
+
+    def save_parameters(self, path):
+        with open(path, "w") as outfile:
+            json.dump(self.parameters(), outfile, indent=2, sort_keys=True)
 
 #  Override these!
     def player_sees_player_and_claims(self, p1, p2, claim, rnd):
@@ -56,8 +151,24 @@ class BaseModel(object):
     def votes(self, team, votes, fail_req, rnd):
         return True
 
+#  Override this to let side-first evaluation score a statement on good/evil
+#  patterns alone. `roles` is the set of role names in the game.
+    def depends_on_roles(self, statement, roles):
+        return True
+
+#  Override this to let big decks be dealt with only the deals a statement
+#  doesn't rule out for certain (whatever the probabilities). Returns a list
+#  of (condition, player, test): test(role, is_good) must hold for player's
+#  card, with is_good the side in the statement's round, whenever condition
+#  -- None, or a (player, test) of the same kind -- holds.
+    def certain(self, statement):
+        return []
+
 
 class DefaultModel(BaseModel):
+    vectorized = True
+    supports_exact = True
+
     def __init__(self, game):
         super(DefaultModel, self).__init__(game)
 
@@ -91,15 +202,12 @@ class DefaultModel(BaseModel):
                 return None
         else:
             if claim is True:
-                return self.lady_will_duck.rand()
+                return self.chance(self.lady_will_duck)
             if claim is False:
-                return not self.lady_will_duck.rand()
+                return self.chance_not(self.lady_will_duck)
 
     def mission(self, team, fails, must_fail, rnd):
-        n_actually_good_people = sum(
-            [int(self.is_good(x, rnd)) for x in team])
-        n_spies = len(team) - n_actually_good_people
-        spy_names = [self.player_role(x) for x in team if self.is_good(x, rnd)]
+        n_spies = self.n_spies(team, rnd)
         if fails > n_spies:
             return None
         if n_spies == 0:
@@ -114,9 +222,9 @@ class DefaultModel(BaseModel):
                 if must_fail:
                     return None
                 if n_spies > 1:
-                    return not self.multiple_spy_one_duck.rand()
+                    return self.chance_not(self.multiple_spy_one_duck)
                 if rnd >= 0 and rnd < 3:
-                    return self.mission_ducks_on_round[rnd].rand()
+                    return self.chance(self.mission_ducks_on_round[rnd])
                 elif rnd == 3:
                     # They always duck on 4
                     return True
@@ -125,9 +233,10 @@ class DefaultModel(BaseModel):
                     return None
             elif fails == 1 and n_spies == 1:
                 # One fail, one spy.
-                spy = spy_names[0]
+                spy = [self.player_role(x) for x in team
+                       if self.is_good(x, rnd)][0]
                 if rnd >= 0 and rnd < 3:
-                    return self.mission_ducks_on_round[rnd].rand()
+                    return self.chance(self.mission_ducks_on_round[rnd])
                 elif rnd == 3:
                     if spy == "Oberon":
                         return True
@@ -137,7 +246,7 @@ class DefaultModel(BaseModel):
                 elif rnd == 4:
                     return True
             elif fails < n_spies:
-                return self.multiple_spy_one_duck.rand()
+                return self.chance(self.multiple_spy_one_duck)
             elif fails > 1:
                 # collision!
                 return True
@@ -146,59 +255,205 @@ class DefaultModel(BaseModel):
         return True
 
     def votes(self, team, votes, fail_req, rnd):
+        likelihood = 1.0
         for player, vote in enumerate(votes):
             role = self.player_role(player)
             if role in special_votes:
-                if special_votes[role](self, player, team,
-                                       votes, fail_req, rnd):
-                    continue
-                else:
-                    return False
+                out = self.timed(special_votes[role])(self, player, team,
+                                                      votes, fail_req, rnd)
+            else:
+                out = self.timed(default_vote)(self, player, team, votes,
+                                               fail_req, rnd)
+            if not out:
+                return False
+            likelihood *= out
+        if self.exact:
+            return likelihood
+        return True
+
+    def depends_on_roles(self, statement, roles):
+        type = statement["type"]
+        if type == "vote":
+            return any(role in roles for role in special_votes)
+        if type == "mission":
+            # Only the one-spy, one-fail case on round 4 looks at a role.
+            return statement["round"] == 4 and statement["fails"] == 1
+        if type == "lady":
+            return "Mordred" in roles
+        return True
+
+    def certain(self, statement):
+        type = statement["type"]
+        if type == "mission":
+            return mission_certain(statement)
+        if type == "lady":
+            honest = (statement["p1"],
+                      lambda role, good: good or role == "Mordred")
+            claim = statement["is good"]
+            return [(honest, statement["p2"],
+                     lambda role, good: good == claim)]
+        return []
+
+    def vec_player_sees_player_and_claims(self, deals, p1, p2, claim, rnd):
+        honest = deals.is_good(p1, rnd) | deals.is_role(p1, "Mordred")
+        truthful = (deals.is_good(p2, rnd) == claim).astype(float)
+        if claim is True:
+            lie = self.lady_will_duck.percentage
+        else:
+            lie = 1.0 - self.lady_will_duck.percentage
+        return np.where(honest, truthful, lie)
+
+    def vec_mission(self, deals, team, fails, must_fail, rnd):
+        n_spies = deals.n_spies(team, rnd)
+        out = np.ones(len(deals))
+        if fails == 0:
+            # They obviously did duck, if there's anyone to duck.
+            if must_fail:
+                out[n_spies > 0] = 0.0
+                return out
+            if rnd >= 0 and rnd < 3:
+                some_spy = self.mission_ducks_on_round[rnd].percentage
+            elif rnd == 4:
+                some_spy = 0.0
             else:
-                if default_vote(self, player, team, votes,
-                                fail_req, rnd):
+                some_spy = 1.0
+            out[n_spies == 1] = some_spy
+            out[n_spies > 1] = 1.0 - self.multiple_spy_one_duck.percentage
+            return out
+        out[fails > n_spies] = 0.0
+        out[n_spies == 0] = 0.0
+        out[fails < n_spies] = self.multiple_spy_one_duck.percentage
+        if fails == 1:
+            one = n_spies == 1
+            if rnd >= 0 and rnd < 3:
+                out[one] = self.mission_ducks_on_round[rnd].percentage
+            elif rnd == 3:
+                # Like mission(), this looks at the first good player's role.
+                first = deals.roles[:, team[0]]
+                for player in reversed(team):
+                    first = np.where(deals.is_good(player, rnd),
+                                     deals.roles[:, player], first)
+                ok = (first == deals.matrix.role_id("Oberon")) | \
+                    (first == deals.matrix.role_id("GLance"))
+                out[one] = ok[one]
+        return out
+
+    def vec_votes(self, deals, team, votes, fail_req, rnd):
+        out = np.ones(len(deals))
+        for player, vote in enumerate(votes):
+            p = self.timed(vec_default_vote)(self, deals, player, team,
+                                             votes, fail_req, rnd)
+            for role, f in vec_special_votes.items():
+                if not deals.has_role(role):
                     continue
-                else:
-                    return False
+                is_role = deals.is_role(player, role)
+                if is_role.any():
+                    p = np.where(is_role,
+                                 self.timed(f)(self, deals, player, team,
+                                               votes, fail_req, rnd),
+                                 p)
+            out *= p
+        return out
+
+
+class BaselineModel(BaseModel):
+    # Nothing but the rules: a fail needs a spy on the team to play it, and a
+    # good player holding the Lady tells the truth. Everything else the rules
+    # allow is equally likely, so it's what the statements say with no
+    # reading of how people play -- a baseline to compare real models with.
+    vectorized = True
+    supports_exact = True
+
+    def player_sees_player_and_claims(self, p1, p2, claim, rnd):
+        if self.is_good(p1, rnd) and self.is_good(p2, rnd) != claim:
+            return None
+        return True
+
+    def mission(self, team, fails, must_fail, rnd):
+        n_spies = self.n_spies(team, rnd)
+        if fails > n_spies:
+            return None
+        if must_fail and n_spies > 0 and fails == 0:
+            return None
+        return True
+
+    def votes(self, team, votes, fail_req, rnd):
         return True
 
+    def depends_on_roles(self, statement, roles):
+        return statement["type"] not in ("vote", "mission", "lady")
+
+    def vec_player_sees_player_and_claims(self, deals, p1, p2, claim, rnd):
+        lying = deals.is_good(p1, rnd) & (deals.is_good(p2, rnd) != claim)
+        return (~lying).astype(float)
+
+    def vec_mission(self, deals, team, fails, must_fail, rnd):
+        n_spies = deals.n_spies(team, rnd)
+        out = (fails <= n_spies).astype(float)
+        if must_fail and fails == 0:
+            out[n_spies > 0] = 0.0
+        return out
+
+    def certain(self, statement):
+        type = statement["type"]
+        if type == "mission":
+            return mission_certain(statement)
+        if type == "lady":
+            claim = statement["is good"]
+            return [((statement["p1"], lambda role, good: good),
+                     statement["p2"], lambda role, good: good == claim)]
+        return []
+
+    def vec_votes(self, deals, team, votes, fail_req, rnd):
+        return np.ones(len(deals))
+
+
+def mission_certain(statement):
+    # Only spies fail missions: as many fails as players means they're all
+    # spies, and a mission the spies had to fail that didn't get one had
+    # none on it.
+    team = statement["team"]
+    fails = statement["fails"]
+    if fails and fails == len(team):
+        return [(None, player, lambda role, good: not good)
+                for player in team]
+    if statement["must fail"] and not fails:
+        return [(None, player, lambda role, good: good) for player in team]
+    return []
+
 
 def default_vote(game, player, team, votes, fail_req, rnd):
-    n_actually_good_people = sum(
-        [int(game.is_good(x, rnd)) for x in team])
-    n_spies = len(team) - n_actually_good_people
+    n_spies = game.n_spies(team, rnd)
     if player in team:
         return True
     if game.is_good(player, rnd):
         if n_spies > fail_req - 1:
             # Bad Team!
             if votes[player] == 1:
-                return game.ignorance_on_round[rnd].rand()
+                return game.chance(game.ignorance_on_round[rnd])
             else:
                 return True
         else:
             # Good Team!
             if votes[player] == 0:
-                return game.ignorance_on_round[rnd].rand()
+                return game.chance(game.ignorance_on_round[rnd])
             else:
                 return True
     else:
         if n_spies < fail_req:
             if votes[player] == 1:
-                return not game.spy_vote_duck_on_round[rnd].rand()
+                return game.chance_not(game.spy_vote_duck_on_round[rnd])
             else:
-                return game.spy_vote_duck_on_round[rnd].rand()
+                return game.chance(game.spy_vote_duck_on_round[rnd])
         elif n_spies == fail_req:
             return True
         elif n_spies > fail_req:
-            return game.multiple_spy_vote_duck.rand()
+            return game.chance(game.multiple_spy_vote_duck)
     return True
 
 
 def merlin_vote(model, player_id, team, votes, fail_req, r):
-    n_actually_good_people = sum(
-        [int(model.is_good(x, r)) for x in team])
-    n_spies = len(team) - n_actually_good_people
+    n_spies = model.n_spies(team, r)
     roles = [model.player_role(x) for x in team]
     if "Mordred" in roles:
         n_spies = n_spies - 1
@@ -211,9 +466,7 @@ def merlin_vote(model, player_id, team, votes, fail_req, r):
             # Voted down an apparently good team. Ignore this.
             return True
         if votes[player_id] == 1:
-            if model.merlin_ignorance.rand():
-                return False
-            return True
+            return model.chance_not(model.merlin_ignorance)
     elif n_spies == 1:
         # He'll either duck or vote it down. Either is fine
         return True
@@ -223,9 +476,7 @@ def merlin_vote(model, player_id, team, votes, fail_req, r):
             # Voted down an apparently good team. Ignore this.
             return True
         if votes[player_id] == 0:
-            if model.merlin_ignorance.rand():
-                return True
-            return False
+            return model.chance(model.merlin_ignorance)
     elif n_spies > 1 and fail_req > 1:
         # Ignore the vote here
         return True
@@ -233,9 +484,7 @@ def merlin_vote(model, player_id, team, votes, fail_req, r):
 
 
 def mordred_vote(game, player_id, team, votes, fail_req, r):
-    n_actually_good_people = sum(
-        [int(game.is_good(x, r)) for x in team])
-    n_spies = len(team) - n_actually_good_people
+    n_spies = game.n_spies(team, r)
     roles = [game.player_role(x) for x in team]
     if "Oberon" in roles:
         n_spies = n_spies - 1
@@ -244,17 +493,12 @@ def mordred_vote(game, player_id, team, votes, fail_req, r):
         return True
     # At this point, this is the number of spies Mordred knows.
     if n_spies == 0:
-        # The chance that merlin doesn't know Mordred is 1 - Merlin's ignorance
-        # Read this as "if Merlin is not ignorant of my role"
-        if not game.merlin_ignorance.rand():
-            if votes[player_id] == 1:
-                return False
-            else:
-                return True
-        # Merlin is ignorant...
-        else:
-            # Vote it up or down, doesn't matter, both could happen
-            return True
+        # Merlin knows Mordred unless he's ignorant, in which case voting it
+        # up or down doesn't matter; both could happen. So voting up is only
+        # as likely as Merlin's ignorance.
+        if votes[player_id] == 1:
+            return game.chance(game.merlin_ignorance)
+        return True
     elif n_spies == 1:
         # He'll either duck or vote it down. Either is fine
         return True
@@ -271,28 +515,32 @@ def guen_vote(game, player_id, team, votes, fail_req, rnd):
     glance = game.get_id_for_role("GLance")
     elance = game.get_id_for_role("ELance")
     if elance == -1 or glance == -1:
-        return default_vote(game, player_id, team, votes, fail_req, rnd)
+        return game.timed(default_vote)(game, player_id, team, votes,
+                                        fail_req, rnd)
     if glance in team and elance in team:
         if votes[player_id] == 1:
             return False
         else:
             return True
     else:
-        return default_vote(game, player_id, team, votes, fail_req, rnd)
+        return game.timed(default_vote)(game, player_id, team, votes,
+                                        fail_req, rnd)
 
 
 def percy_vote(game, player_id, team, votes, fail_req, rnd):
     morgana = game.get_id_for_role("Morgana")
     merlin = game.get_id_for_role("Merlin")
     if merlin == -1 or morgana == -1:
-        return default_vote(game, player_id, team, votes, fail_req, rnd)
+        return game.timed(default_vote)(game, player_id, team, votes,
+                                        fail_req, rnd)
     if merlin in team and morgana in team:
         if votes[player_id] == 1:
             return False
         else:
             return True
     else:
-        return default_vote(game, player_id, team, votes, fail_req, rnd)
+        return game.timed(default_vote)(game, player_id, team, votes,
+                                        fail_req, rnd)
 
 special_votes = {
     "Merlin": merlin_vote,
@@ -300,3 +548,80 @@ special_votes = {
     "Guen": guen_vote,
     "Percy": percy_vote
 }
+
+
+# Vectorized counterparts of the vote functions above. Each returns, for
+# every deal in the view, the probability that the scalar version returns
+# True.
+
+def vec_default_vote(model, deals, player, team, votes, fail_req, rnd):
+    n = len(deals)
+    if player in team:
+        return np.ones(n)
+    n_spies = deals.n_spies(team, rnd)
+    ignorance = model.ignorance_on_round[rnd].percentage
+    duck = model.spy_vote_duck_on_round[rnd].percentage
+    if votes[player] == 1:
+        good_p = np.where(n_spies > fail_req - 1, ignorance, 1.0)
+        evil_p = np.where(n_spies < fail_req, 1.0 - duck, 1.0)
+    else:
+        good_p = np.where(n_spies > fail_req - 1, 1.0, ignorance)
+        evil_p = np.where(n_spies < fail_req, duck, 1.0)
+    evil_p = np.where(n_spies > fail_req,
+                      model.multiple_spy_vote_duck.percentage, evil_p)
+    return np.where(deals.is_good(player, rnd), good_p, evil_p)
+
+
+def vec_merlin_vote(model, deals, player_id, team, votes, fail_req, r):
+    n = len(deals)
+    if player_id in team:
+        return np.ones(n)
+    n_spies = deals.n_spies(team, r) - deals.team_has_role(team, "Mordred")
+    ignorance = model.merlin_ignorance.percentage
+    out = np.ones(n)
+    if votes[player_id] == 1:
+        out[n_spies == 0] = 1.0 - ignorance
+    elif fail_req == 1:
+        out[n_spies > 1] = ignorance
+    return out
+
+
+def vec_mordred_vote(model, deals, player_id, team, votes, fail_req, r):
+    n = len(deals)
+    if player_id in team:
+        return np.ones(n)
+    n_spies = deals.n_spies(team, r) - deals.team_has_role(team, "Oberon")
+    out = np.ones(n)
+    if votes[player_id] == 1:
+        out[n_spies == 0] = model.merlin_ignorance.percentage
+    if fail_req == 1:
+        out[n_spies > 1] = 0.0
+    return out
+
+
+def _vec_pair_vote(model, deals, player_id, team, votes, fail_req, rnd,
+                   first, second):
+    p = model.timed(vec_default_vote)(model, deals, player_id, team, votes,
+                                      fail_req, rnd)
+    a = deals.id_for_role(first)
+    b = deals.id_for_role(second)
+    both = np.in1d(a, team) & np.in1d(b, team) & (a != -1) & (b != -1)
+    return np.where(both, float(votes[player_id] != 1), p)
+
+
+def vec_guen_vote(model, deals, player_id, team, votes, fail_req, rnd):
+    return _vec_pair_vote(model, deals, player_id, team, votes, fail_req,
+                          rnd, "GLance", "ELance")
+
+
+def vec_percy_vote(model, deals, player_id, team, votes, fail_req, rnd):
+    return _vec_pair_vote(model, deals, player_id, team, votes, fail_req,
+                          rnd, "Merlin", "Morgana")
+
+
+vec_special_votes = {
+    "Merlin": vec_merlin_vote,
+    "Mordred": vec_mordred_vote,
+    "Guen": vec_guen_vote,
+    "Percy": vec_percy_vote
+}
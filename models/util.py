@@ -1,3 +1,4 @@
+import numpy as np
 import random
 
 
@@ -5,8 +6,56 @@ class Bernoulli(object):
     def __init__(self, percentage):
         self.percentage = percentage
 
-    def rand(self):
-        return random.random() < self.percentage
+    def rand(self, stream=random):
+        return stream.random() < self.percentage
 
     def random(self):
         return self.rand()
+
+
+class RandomStream(object):
+    # A seedable source of uniform draws, handed out from large blocks
+    # generated by NumPy so the per-draw cost in the inner loop is tiny.
+    # Seeding it again restarts the exact same sequence.
+    def __init__(self, seed=None, block_size=1 << 16):
+        self.block_size = block_size
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self.state = np.random.RandomState(seed)
+        self._draws = iter(())
+
+    def random(self):
+        try:
+            return next(self._draws)
+        except StopIteration:
+            self._draws = iter(
+                self.state.random_sample(self.block_size).tolist())
+            return next(self._draws)
+
+    def binomial(self, n, p):
+        return self.state.binomial(n, p)
+
+
+class Monomial(object):
+    # coefficient * prod(p[k] ** a * (1 - p[k]) ** b for k, (a, b) in powers),
+    # p being the model's parameters in some fixed order. A model whose
+    # chance helpers hand these out (see BaseModel.symbolic) returns its
+    # likelihood as a formula in its parameters rather than as a number.
+    def __init__(self, coefficient=1.0, powers=None):
+        self.coefficient = coefficient
+        self.powers = powers or {}
+
+    def __mul__(self, other):
+        if not isinstance(other, Monomial):
+            return Monomial(self.coefficient * float(other), self.powers)
+        powers = dict(self.powers)
+        for k, (a, b) in other.powers.items():
+            a0, b0 = powers.get(k, (0, 0))
+            powers[k] = (a0 + a, b0 + b)
+        return Monomial(self.coefficient * other.coefficient, powers)
+
+    __rmul__ = __mul__
+
+    def __nonzero__(self):
+        return self.coefficient != 0
@@ -0,0 +1,141 @@
+import itertools
+
+import numpy as np
+
+from deals import Trace
+from game_evaluator import MISSION_SIZES, fails_required
+from mcmc import CardTally
+
+
+# What to do next at the table: which team to propose, or whom the Lady
+# should look at, to learn the most about who's evil.
+#
+# Both work off the deals (and weights) of the game's last eval. For each
+# candidate, every outcome the game could record next (how many fails the
+# mission gets, what the Lady's holder claims) is scored against those
+# deals with the model's vec_* functions and normalized over the outcomes.
+# A candidate is worth the mutual information, in bits, between its outcome
+# and the set of evil players. Outcomes that only depend on alignment are
+# scored once per distinct set of evil players rather than once per deal,
+# which is what makes trying every team of a round quick.
+
+
+def current_round(game):
+    # The round the next mission is for: one past the missions so far.
+    missions = len([s for s in game.seen if s["type"] == "mission"])
+    return min(missions + 1, 5)
+
+
+def entropy(p):
+    p = p[p > 0]
+    return max(0.0, float(-(p * np.log2(p)).sum()))
+
+
+class WhatIf(object):
+    def __init__(self, game):
+        trace = game.trace
+        if trace is None:
+            raise ValueError("Run an eval first")
+        if isinstance(trace, CardTally) or not isinstance(trace, Trace):
+            raise ValueError("Needs the deals of an eval that went through "
+                             "the deck (not --mcmc)")
+        if not game.model.vectorized:
+            raise ValueError("%s has no vec_* functions" %
+                             type(game.model).__name__)
+        rows, weights = trace.sparse()
+        if not len(rows):
+            raise ValueError("No deal fits the statements")
+        self.game = game
+        self.matrix = trace.matrix
+        self.rows = rows
+        self.weights = weights / weights.sum()
+        # Deals by their starting alignment; representatives[s] is one deal
+        # of each.
+        self.sides, self.representatives, self.pattern = np.unique(
+            self.matrix.good[rows], return_index=True, return_inverse=True)
+        self.side_weights = np.bincount(self.pattern, weights=self.weights)
+
+    def uncertainty(self):
+        # Bits of uncertainty left about who's evil.
+        return entropy(self.side_weights)
+
+    def outcomes(self, statements):
+        # The joint distribution of the evil set (rows) and which of
+        # `statements` the game records next (columns).
+        vector = self.game.vector
+        switches = self.game.lancelots_switch_at
+        by_deal = any(vector.depends_on_roles(s) for s in statements)
+        if by_deal:
+            deals = self.matrix.view(self.rows, switches)
+        else:
+            deals = self.matrix.view(self.rows[self.representatives],
+                                     switches)
+        likelihood = np.column_stack([vector.likelihood(s, deals)
+                                      for s in statements])
+        total = likelihood.sum(axis=1)
+        # Deals under which none of the outcomes could happen drop out.
+        chances = likelihood / np.where(total > 0, total, 1.0)[:, None]
+        if by_deal:
+            joint = np.column_stack([
+                np.bincount(self.pattern, weights=self.weights * column,
+                            minlength=len(self.sides))
+                for column in chances.T])
+        else:
+            joint = self.side_weights[:, None] * chances
+        return joint / joint.sum()
+
+    def information(self, joint):
+        # Mutual information, in bits, of a joint distribution.
+        sides = joint.sum(axis=1)[:, None]
+        outcomes = joint.sum(axis=0)[None, :]
+        hit = joint > 0
+        return float((joint[hit] * np.log2(
+            joint[hit] / (sides * outcomes)[hit])).sum())
+
+    def teams(self, size=None, round=None):
+        # Every team of `size` for the round, best first, as dicts of the
+        # team, the bits its mission would tell and the chance it passes.
+        n_players = self.game.n_players
+        if round is None:
+            round = current_round(self.game)
+        if size is None:
+            if n_players not in MISSION_SIZES:
+                raise ValueError("Need a team size for %d players" %
+                                 n_players)
+            size = MISSION_SIZES[n_players][round - 1]
+        needed = fails_required(n_players, round)
+        out = []
+        for team in itertools.combinations(range(n_players), size):
+            team = list(team)
+            joint = self.outcomes([{"type": "mission",
+                                    "team": team,
+                                    "fails": fails,
+                                    "must fail": False,
+                                    "round": round}
+                                   for fails in range(size + 1)])
+            out.append({"team": team,
+                        "bits": self.information(joint),
+                        "passes": float(joint[:, :needed].sum())})
+        out.sort(key=lambda t: -t["bits"])
+        return out
+
+    def lady(self, holder, round=None):
+        # Every player the Lady's holder could look at, best first, with
+        # the bits the claim would tell and the chance it's "good".
+        if round is None:
+            round = current_round(self.game)
+        out = []
+        for target in range(self.game.n_players):
+            if target == holder:
+                continue
+            joint = self.outcomes([{"type": "lady",
+                                    "p1": holder,
+                                    "p2": target,
+                                    "is good": claim,
+                                    "round": round}
+                                   for claim in (True, False)])
+            out.append({"target": target,
+                        "bits": self.information(joint),
+                        "claims good": float(joint[:, 0].sum())})
+        out.sort(key=lambda t: -t["bits"])
+        return out
@@ -0,0 +1,536 @@
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import multiprocessing
+import os
+import SocketServer
+import sys
+import threading
+import time
+
+from batch import posteriors
+from models.default_model import DefaultModel
+from game_evaluator import DeceptionGame, SavedGame, save_metadata
+
+
+# Hosts many games at once, for a night of several tables, as a small JSON
+# API over HTTP (or a Unix socket):
+#
+#   python server.py --port 8080 -j 4
+#
+#   POST   /games                   start a game: a save file's JSON, or
+#                                   {"game_size": n, "player_names": {...},
+#                                    "roles": [...], "statements": [...],
+#                                    "parameters": {...}}
+#   GET    /games                   every game and its eval status
+#   GET    /games/<id>              the game as a save file
+#   DELETE /games/<id>              end it
+#   POST   /games/<id>/statements   add a statement, or a list of them
+#   DELETE /games/<id>/statements/<i>  disbelieve statement i
+#   POST   /games/<id>/eval         evaluate; the body holds eval options
+#                                   (length, quick, exact, tolerance,
+#                                   time_budget, seed, side_first, mcmc)
+#   GET    /games/<id>/report       the latest report; ?wait=<seconds>
+#                                   waits for a queued or running eval
+#
+# The server process only keeps each game's statements. Evals run in a
+# pool of worker processes shared by every game: each game has at most one
+# eval running, the games waiting take turns, and a new request for a
+# waiting game replaces the old one. Once a game has asked for an eval,
+# adding or disbelieving a statement queues that eval again.
+#
+# An eval that fails outside the model code, or runs past --timeout (a
+# worker killed mid-eval never reports back), marks its game "error"; the
+# pool is then replaced and the other running evals queued again.
+#
+# Memory stays bounded: each worker keeps its last --cache games (with
+# their cached columns), and deal tables are memory-mapped from the
+# deals.py cache and shared by the games of a size within a worker
+# (DealMatrix.shared). The worker's cache is best-effort: the pool hands an
+# eval to whichever worker is free, so new statements are only scored
+# incrementally when a game's eval lands on a worker that still has it.
+
+
+EVAL_OPTIONS = ("length", "quick", "exact", "tolerance", "time_budget",
+                "seed", "side_first", "mcmc")
+
+STATEMENT_TYPES = ("vote", "mission", "lady", "switch", "known_side",
+                   "known_role")
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+# Per worker process: the games it evaluated last, by session id.
+WORKER_GAMES = collections.OrderedDict()
+WORKER_CACHE = 2
+
+
+def init_worker(cache):
+    global WORKER_CACHE
+    WORKER_CACHE = cache
+
+
+def worker_game(sid, player_array, parameters, seen):
+    # The worker's game for a session, brought up to date: statements the
+    # cached one already has keep their cached columns.
+    game = WORKER_GAMES.pop(sid, None)
+    if game is None or game.player_array != player_array or \
+       game.model.parameters() != parameters or \
+       game.seen != seen[:len(game.seen)]:
+        game = DeceptionGame(player_array, DefaultModel)
+        game.set_parameters(parameters)
+    game.load_save(seen[len(game.seen):])
+    WORKER_GAMES[sid] = game
+    while len(WORKER_GAMES) > WORKER_CACHE:
+        WORKER_GAMES.popitem(last=False)
+    return game
+
+
+def run_eval(job):
+    sid, generation, player_array, parameters, seen, eval_kwargs = job
+    started = time.time()
+    try:
+        game = worker_game(sid, player_array, parameters, seen)
+        if "length" not in eval_kwargs:
+            # The REPL's default number of repetitions.
+            eval_kwargs = dict(eval_kwargs,
+                               length=200 / (game.n_players - 4) * 2)
+        game.eval(**eval_kwargs)
+        result = {"players": posteriors(game, {})}
+    except Exception, e:
+        WORKER_GAMES.pop(sid, None)
+        result = {"error": "%s: %s" % (type(e).__name__, e)}
+    result["seconds"] = round(time.time() - started, 3)
+    result["constraints"] = len(seen)
+    return sid, generation, result
+
+
+class Session(object):
+    # One table: a DeceptionGame used to check and hold statements (it
+    # never enumerates a deck here), and the state of its evals.
+    def __init__(self, sid, player_array, namemap, parameters):
+        self.sid = sid
+        self.game = DeceptionGame(player_array, DefaultModel)
+        if parameters:
+            self.game.set_parameters(parameters)
+        self.namemap = namemap
+        # Bumped on every change, so results of evals of older statements
+        # are recognized as stale.
+        self.generation = 0
+        self.eval_kwargs = None
+        self.status = "idle"
+        self.report = None
+
+    def job(self):
+        return (self.sid, self.generation, self.game.player_array,
+                self.game.model.parameters(), list(self.game.seen),
+                self.eval_kwargs)
+
+    def summary(self):
+        return {"id": self.sid,
+                "game_size": self.game.n_players,
+                "constraints": len(self.game.seen),
+                "status": self.status}
+
+    def save_file(self):
+        return [save_metadata(self.game, self.namemap)] + self.game.seen
+
+
+class Scheduler(object):
+    # Hands evals to the worker pool: at most one per session at a time,
+    # and the sessions waiting take turns, so a table asking for a long
+    # eval can't hold up the others.
+    def __init__(self, sessions, workers, cache, tasks_per_worker, timeout):
+        self.sessions = sessions
+        self.workers = workers
+        self.cache = cache
+        self.tasks_per_worker = tasks_per_worker
+        self.timeout = timeout
+        self.pool = self.new_pool()
+        self.lock = threading.Condition()
+        # Session ids with an eval to start, in the order they'll start.
+        self.waiting = collections.deque()
+        # Session id to (ticket, AsyncResult, deadline) of its running eval.
+        self.running = {}
+        self.tickets = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.dispatch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_pool(self):
+        return multiprocessing.Pool(
+            self.workers, init_worker, (self.cache,),
+            maxtasksperchild=self.tasks_per_worker)
+
+    def submit(self, session):
+        # Call with the lock held.
+        session.status = "queued"
+        if session.sid not in self.waiting:
+            self.waiting.append(session.sid)
+        self.lock.notify_all()
+
+    def next_job(self):
+        for sid in list(self.waiting):
+            if sid not in self.running:
+                self.waiting.remove(sid)
+                if sid in self.sessions:
+                    return self.sessions[sid]
+        return None
+
+    def dispatch(self):
+        with self.lock:
+            while not self.closed:
+                self.reap()
+                session = None
+                if len(self.running) < self.workers:
+                    session = self.next_job()
+                if session is None:
+                    self.lock.wait(1.0)
+                    continue
+                session.status = "running"
+                self.tickets += 1
+                ticket = self.tickets
+                result = self.pool.apply_async(
+                    run_eval, (session.job(),),
+                    callback=lambda done, ticket=ticket:
+                        self.finished(done, ticket))
+                self.running[session.sid] = (ticket, result,
+                                             time.time() + self.timeout)
+
+    def reap(self):
+        # Call with the lock held. Python 2's pool has no error callback,
+        # and loses the job of a worker that dies, so failed and overdue
+        # evals are found here.
+        stuck = False
+        for sid, (ticket, result, deadline) in list(self.running.items()):
+            if result.ready() and not result.successful():
+                try:
+                    result.get()
+                except Exception, e:
+                    self.fail(sid, "%s: %s" % (type(e).__name__, e))
+            elif not result.ready() and time.time() > deadline:
+                self.fail(sid, "The eval didn't finish within %g seconds" %
+                          self.timeout)
+                stuck = True
+        if not stuck:
+            return
+        # A pool job can't be cancelled, so the pool goes, and the evals it
+        # was still running start over on a new one.
+        for sid in self.running:
+            if sid not in self.waiting:
+                self.waiting.appendleft(sid)
+            if sid in self.sessions:
+                self.sessions[sid].status = "queued"
+        self.running.clear()
+        old, self.pool = self.pool, self.new_pool()
+        # Not under the lock: terminating waits for the old pool's result
+        # thread, which may be waiting for the lock in finished().
+        terminator = threading.Thread(target=old.terminate)
+        terminator.daemon = True
+        terminator.start()
+
+    def fail(self, sid, message):
+        # Call with the lock held.
+        del self.running[sid]
+        session = self.sessions.get(sid)
+        if session is not None and session.status == "running":
+            session.report = {"error": message,
+                              "constraints": len(session.game.seen)}
+            session.status = "error"
+        self.lock.notify_all()
+
+    def finished(self, done, ticket):
+        sid, generation, result = done
+        with self.lock:
+            if self.running.get(sid, (None,))[0] != ticket:
+                # Given up on by reap().
+                return
+            del self.running[sid]
+            session = self.sessions.get(sid)
+            if session is not None and generation == session.generation:
+                for player in result.get("players", []):
+                    player["name"] = session.namemap.get(
+                        str(player["player"]), "")
+                session.report = result
+                session.status = "error" if "error" in result else "done"
+            elif session is not None and session.status == "running":
+                # Statements changed while it ran; the re-queued eval is
+                # the one to wait for.
+                session.status = "queued"
+            self.lock.notify_all()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.pool.terminate()
+        self.pool.join()
+
+
+class Tables(object):
+    # The sessions, and what the HTTP handler can do with them.
+    def __init__(self, workers, cache, max_games, tasks_per_worker,
+                 timeout):
+        self.sessions = {}
+        self.next_id = 1
+        self.max_games = max_games
+        self.scheduler = Scheduler(self.sessions, workers, cache,
+                                   tasks_per_worker, timeout)
+        self.lock = self.scheduler.lock
+
+    def session(self, sid):
+        if sid not in self.sessions:
+            raise RequestError(404, "No game %s" % sid)
+        return self.sessions[sid]
+
+    def create(self, body):
+        if isinstance(body, list):
+            if not body:
+                raise RequestError(400, "Empty save file")
+            if not isinstance(body[0], dict):
+                raise RequestError(400, "A save file starts with the game's "
+                                   "metadata object")
+            body = dict(body[0], statements=body[1:])
+        if not isinstance(body, dict):
+            raise RequestError(400, "A game is a save file or a JSON object")
+        try:
+            player_array = SavedGame(body)
+            game_size = int(body.get("game_size", len(player_array)))
+        except (KeyError, TypeError, ValueError):
+            raise RequestError(400, "Need a game_size, or roles as "
+                               "[role, is good] pairs")
+        if not 5 <= len(player_array) <= 32 or \
+           len(player_array) != game_size:
+            raise RequestError(400, "Games have 5 to 32 players (and "
+                               "more than 10 need their roles)")
+        with self.lock:
+            if len(self.sessions) >= self.max_games:
+                raise RequestError(503, "Too many games; end one first")
+            sid = str(self.next_id)
+            self.next_id += 1
+            try:
+                session = Session(sid, player_array,
+                                  body.get("player_names") or {},
+                                  body.get("parameters"))
+            except (KeyError, ValueError), e:
+                raise RequestError(400, "Bad parameters: %s" % e)
+            self.add_statements(session, body.get("statements") or [])
+            self.sessions[sid] = session
+            return session.summary()
+
+    def add_statements(self, session, statements):
+        # Call with the lock held.
+        if isinstance(statements, dict):
+            statements = [statements]
+        if not isinstance(statements, list):
+            raise RequestError(400, "Need a statement or a list of them")
+        for statement in statements:
+            if not isinstance(statement, dict) or \
+               statement.get("type") not in STATEMENT_TYPES:
+                raise RequestError(400, "Statements are one of: %s" %
+                                   ", ".join(STATEMENT_TYPES))
+        before = len(session.game.seen)
+        try:
+            session.game.load_save(statements)
+        except (KeyError, TypeError, ValueError), e:
+            for i in range(len(session.game.seen) - 1, before - 1, -1):
+                session.game.disbelieve(i)
+            raise RequestError(400, "Bad statement: %s" % e)
+        self.changed(session)
+
+    def changed(self, session):
+        session.generation += 1
+        if session.eval_kwargs is not None and session.status != "idle":
+            self.scheduler.submit(session)
+
+    def disbelieve(self, session, i):
+        if not 0 <= i < len(session.game.seen):
+            raise RequestError(404, "No statement %d" % i)
+        session.game.disbelieve(i)
+        self.changed(session)
+
+    def evaluate(self, session, options):
+        if not isinstance(options, dict):
+            raise RequestError(400, "Eval options are a JSON object")
+        unknown = set(options) - set(EVAL_OPTIONS)
+        if unknown:
+            raise RequestError(400, "Unknown eval options: %s" %
+                               ", ".join(sorted(unknown)))
+        session.eval_kwargs = options
+        session.generation += 1
+        self.scheduler.submit(session)
+
+    def report(self, session, wait):
+        deadline = time.time() + wait
+        while session.status in ("queued", "running") and \
+                time.time() < deadline:
+            self.lock.wait(deadline - time.time())
+        out = session.summary()
+        out["report"] = session.report
+        out["stale"] = session.report is not None and \
+            session.report["constraints"] != len(session.game.seen)
+        return out
+
+    def handle(self, method, path, query, body):
+        parts = [p for p in path.split("/") if p]
+        if not parts or parts[0] != "games":
+            raise RequestError(404, "Not found")
+        if len(parts) == 1:
+            if method == "GET":
+                with self.lock:
+                    return 200, [s.summary() for _, s in
+                                 sorted(self.sessions.items(),
+                                        key=lambda i: int(i[0]))]
+            if method == "POST":
+                return 201, self.create(body)
+        with self.lock:
+            session = self.session(parts[1])
+            if len(parts) == 2:
+                if method == "GET":
+                    return 200, session.save_file()
+                if method == "DELETE":
+                    del self.sessions[session.sid]
+                    if session.sid in self.scheduler.waiting:
+                        self.scheduler.waiting.remove(session.sid)
+                    return 200, session.summary()
+            elif parts[2] == "statements":
+                if len(parts) == 3 and method == "POST":
+                    self.add_statements(session, body)
+                    return 200, session.summary()
+                if len(parts) == 4 and method == "DELETE":
+                    try:
+                        i = int(parts[3])
+                    except ValueError:
+                        raise RequestError(404, "No statement %s" % parts[3])
+                    self.disbelieve(session, i)
+                    return 200, session.summary()
+            elif len(parts) == 3 and parts[2] == "eval" and method == "POST":
+                self.evaluate(session, body or {})
+                return 202, session.summary()
+            elif len(parts) == 3 and parts[2] == "report" and \
+                    method == "GET":
+                try:
+                    wait = float(query.get("wait", 0))
+                except ValueError:
+                    raise RequestError(400, "wait is a number of seconds")
+                return 200, self.report(session, wait)
+        raise RequestError(405, "Can't %s %s" % (method, path))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def respond(self, method):
+        path, _, query_string = self.path.partition("?")
+        query = dict(p.partition("=")[::2]
+                     for p in query_string.split("&") if p)
+        try:
+            body = None
+            length = int(self.headers.getheader("content-length") or 0)
+            if length:
+                try:
+                    body = json.loads(self.rfile.read(length))
+                except ValueError:
+                    raise RequestError(400, "Body isn't JSON")
+            status, out = self.server.tables.handle(method, path, query, body)
+        except RequestError, e:
+            status, out = e.status, {"error": str(e)}
+        except Exception, e:
+            # Still an answer, so a bug can't leave the client hanging up.
+            self.log_error("%s %s failed: %s: %s", method, self.path,
+                           type(e).__name__, e)
+            status, out = 500, {"error": "%s: %s" % (type(e).__name__, e)}
+        data = json.dumps(out, sort_keys=True)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def do_DELETE(self):
+        self.respond("DELETE")
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            sys.stderr.write("%s - - [%s] %s\n" % (
+                self.address_string(), self.log_date_time_string(),
+                format % args))
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Serve many Tim the Enchanter games over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", default=None,
+                        help="listen on this Unix socket instead")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="evals to run at once")
+    parser.add_argument("--cache", type=int, default=2,
+                        help="games each worker keeps between evals")
+    parser.add_argument("--max-games", type=int, default=64,
+                        help="most games to host at once")
+    parser.add_argument("--tasks-per-worker", type=int, default=200,
+                        help="evals before a worker process is replaced")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="seconds before a running eval is given up on")
+    parser.add_argument("--quiet", action="store_true",
+                        help="don't log requests")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    tables = Tables(max(1, args.jobs), max(1, args.cache), args.max_games,
+                    args.tasks_per_worker, args.timeout)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        where = args.socket
+    else:
+        server = HTTPServer((args.host, args.port), Handler)
+        where = "http://%s:%d" % server.server_address
+    server.tables = tables
+    server.quiet = args.quiet
+    sys.stderr.write("Serving on %s\n" % where)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        tables.scheduler.close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,58 @@
+import time
+
+
+class ObservationStats(object):
+    # What one observation has cost and decided so far. The sampling loop
+    # counts deals it accepted (trues), rejected by chance (falses) and
+    # ruled impossible (nones); the vectorized evaluator adds up the
+    # probabilities instead, so its trues and falses are expected counts.
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.trues = 0
+        self.falses = 0
+        self.nones = 0
+
+    def cost_per_rejection(self):
+        # Observations we know nothing about sort first, so they get
+        # measured; ones that never reject sort last.
+        if not self.calls:
+            return 0.0
+        rejections = self.falses + self.nones
+        if not rejections:
+            return float("inf")
+        return self.seconds / rejections
+
+    def as_dict(self):
+        return {"calls": self.calls,
+                "seconds": self.seconds,
+                "accepted": self.trues,
+                "rejected": self.falses,
+                "impossible": self.nones}
+
+
+class Profile(object):
+    # Calls and seconds per model function, for models that route their
+    # calls through BaseModel.timed. Times are inclusive: a vote handler
+    # that falls back to default_vote counts that call too.
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+
+    def wrap(self, f):
+        name = f.__name__
+
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.seconds[name] = self.seconds.get(name, 0.0) + \
+                    time.time() - started
+                self.calls[name] = self.calls.get(name, 0) + 1
+        return timed
+
+    def as_dict(self):
+        return dict((name, {"calls": self.calls[name],
+                            "seconds": self.seconds[name]})
+                    for name in self.calls)
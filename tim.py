@@ -1,16 +1,30 @@
 import os
 import readline
 import sys
+import threading
 import colorama
 import json
 from colorama import Fore, Style
 
-from models.default_model import DefaultModel
-from game_evaluator import DeceptionGame, AvalonGame
+from models import default_model
+from models.default_model import DefaultModel, BaselineModel
+from game_evaluator import DeceptionGame, AvalonGame, SavedGame, \
+    blend, parameter_grid, save_metadata
+from recommend import WhatIf
 
 
+# Seconds a cancelled eval gets to stop before the next one gives up on
+# reusing its game (an exact eval only notices at the end).
+STOP_WAIT = 1.0
 
-def repl_report(report, namemap, ngood):
+
+def margin(errors, i, kind, key):
+    if errors is None or errors[i][kind].get(key) is None:
+        return ""
+    return " (+/-%.1f%%)" % (errors[i][kind][key] * 100)
+
+
+def repl_report(report, namemap, ngood, errors=None):
     sort_order = sorted(
         [(report[i]["side"].get(True, 0.0), i)
          for i in range(len(report))],
@@ -18,10 +32,11 @@ def repl_report(report, namemap, ngood):
 
     still_good = 0
     for goodness, i in sort_order:
-        row = "%s: %2f%% Good %2f%% Evil" % (
+        row = "%s: %2f%% Good %2f%% Evil%s" % (
             namemap.get(i, "") + " (%s)" % str(i),
             goodness * 100,
-            (1.0 - goodness) * 100)
+            (1.0 - goodness) * 100,
+            margin(errors, i, "side", True))
         if still_good < ngood:
             print(Fore.CYAN + Style.BRIGHT + row)
         else:
@@ -34,8 +49,8 @@ def repl_report(report, namemap, ngood):
             if role == "":
                 has_roles = False
                 break
-            row += "%2.1f%% %s " % (
-                score * 100, role)
+            row += "%2.1f%%%s %s " % (
+                score * 100, margin(errors, i, "role", role), role)
         if has_roles:
             print(row)
 
@@ -55,6 +70,253 @@ def display_statement(statement, namemap):
     return out
 
 
+class BackgroundEval(object):
+    # Runs an eval of `game` (the REPL's eval-side copy, see eval_game) in a
+    # worker thread, so the prompt stays free for the next statement. After
+    # every batch the partial posterior is published for `report`; cancel()
+    # stops the eval soon after.
+    def __init__(self, game, args):
+        self.args = args
+        self.game = game
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.report = None
+        self.errors = None
+        self.samples = None
+        self.batches = 0
+        self.done = False
+        self.failure = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.game.eval(on_batch=self.publish,
+                           stop=self.cancelled.is_set, **self.args)
+            self.publish(None)
+        except Exception, e:
+            self.failure = e
+        finally:
+            self.done = True
+
+    def publish(self, samples):
+        report = self.game.report()
+        errors = self.game.get_player_errors()
+        with self.lock:
+            self.report = report
+            self.errors = errors
+            if samples is not None:
+                self.samples = samples
+                self.batches += 1
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def stop(self, timeout=STOP_WAIT):
+        # Cancels the eval and gives it `timeout` seconds to wind down;
+        # True once it has, and its game is free again.
+        self.cancel()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def wait(self):
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def latest(self):
+        with self.lock:
+            return self.report, self.errors, self.samples, self.batches
+
+
+def background_report(background, namemap, ngood):
+    report, errors, samples, batches = background.latest()
+    if background.failure is not None:
+        status = "failed: %s" % background.failure
+    elif not background.done:
+        status = "still running"
+    elif background.cancelled.is_set():
+        status = "cancelled"
+    else:
+        status = "done"
+    if samples is None:
+        print(Fore.GREEN + "Eval %s" % status)
+    else:
+        print(Fore.GREEN + "Eval %s; %d samples from %d batches" % (
+            status, samples, batches))
+    if report is not None:
+        repl_report(report, namemap, ngood, errors)
+
+
+def repl_stats(stats, seen, namemap):
+    rows = sorted(stats["observations"], key=lambda r: -r["seconds"])
+    if not rows:
+        # Cached per-assertion results make repeat evals free.
+        print("Nothing has been evaluated since the last reset")
+        return
+    print(Fore.GREEN + "Observations (most expensive first):")
+    print("  #  evaluator       calls   seconds   accepted   rejected"
+          " impossible")
+    for row in rows:
+        print("%3d: %-10s %10d %9.3f %10.1f %10.1f %10d  %s" % (
+            row["index"], row["evaluator"], row["calls"], row["seconds"],
+            row["accepted"], row["rejected"], row["impossible"],
+            display_statement(seen[row["index"]], namemap)))
+    if stats["model"] is None:
+        print("Model functions aren't being timed; try 'stats on'")
+        return
+    print(Fore.GREEN + "Model functions (most expensive first):")
+    for name, row in sorted(stats["model"].items(),
+                            key=lambda item: -item[1]["seconds"]):
+        print("  %-35s %10d calls %9.3fs %8.2fus/call" % (
+            name, row["calls"], row["seconds"],
+            row["seconds"] / row["calls"] * 1e6))
+
+
+def sweep_args(command_list):
+    # "name=v1,v2 other=v3 --quick" to a parameter grid and eval options.
+    grid = {}
+    args = {}
+    for arg in command_list[1:]:
+        if arg == "--quick":
+            args["quick"] = True
+        elif "=" in arg:
+            name, values = arg.split("=", 1)
+            grid[name] = [float(v) for v in values.split(",") if v]
+        elif arg != "":
+            raise ValueError("Expected name=value,value,...: %s" % arg)
+    return parameter_grid(grid), args
+
+
+def repl_sweep(game, settings, reports, namemap):
+    # One row per player, one column of P(good) per setting.
+    print(Fore.GREEN + "Chance of being good under each setting:")
+    for k, setting in enumerate(settings):
+        print("  [%d] %s" % (k, ", ".join(
+            "%s=%g" % item for item in sorted(setting.items()))))
+    print("%-16s" % "" + "".join("%8s" % ("[%d]" % k)
+                                 for k in range(len(settings))))
+    for i in range(game.n_players):
+        name = namemap.get(i, "") + " (%d)" % i
+        print("%-16s" % name + "".join(
+            "%7.1f%%" % (report[i]["side"].get(True, 0.0) * 100)
+            for report in reports))
+
+
+def ensemble_args(game, command_list):
+    # "[Model ...] [--quick]" to model classes, by default the game's own
+    # model against the rules-only baseline.
+    classes = []
+    args = {}
+    for arg in command_list[1:]:
+        if arg == "--quick":
+            args["quick"] = True
+        elif arg != "":
+            model_class = getattr(default_model, arg, None)
+            if not isinstance(model_class, type) or \
+               not issubclass(model_class, default_model.BaseModel):
+                raise ValueError("No model called %s" % arg)
+            classes.append(model_class)
+    if not classes:
+        classes = [type(game.model), BaselineModel]
+    return classes, args
+
+
+def repl_ensemble(game, classes, reports, namemap):
+    # One row per player, one column of P(good) per model and one for the
+    # even mix of them.
+    print(Fore.GREEN + "Chance of being good under each model:")
+    names = [c.__name__[:15] for c in classes] + ["blend"]
+    print("%-16s" % "" + "".join("%16s" % name for name in names))
+    reports = reports + [blend(reports)]
+    for i in range(game.n_players):
+        name = namemap.get(i, "") + " (%d)" % i
+        print("%-16s" % name + "".join(
+            "%15.1f%%" % (report[i]["side"].get(True, 0.0) * 100)
+            if report[i]["side"] else "%16s" % "no deal fits"
+            for report in reports))
+
+
+def repl_timeline(game, reports, namemap):
+    # One row per statement, one column of P(good) per player: the odds
+    # with the statements up to and including that row's.
+    print(Fore.GREEN + "Chance of being good after each statement:")
+    print("%-16s" % "" + "".join(
+        "%8s" % (namemap.get(i, "") or "(%d)" % i)[:7]
+        for i in range(game.n_players)))
+    for k, report in enumerate(reports):
+        if k == 0:
+            label = "start"
+        else:
+            statement = game.seen[k - 1]
+            label = "%2d %s" % (k - 1, statement["type"])
+            if statement.get("round") is not None:
+                label += " r%s" % statement["round"]
+        if not report[0]["side"]:
+            print("%-16s  (no deal fits)" % label)
+            continue
+        print("%-16s" % label + "".join(
+            "%7.1f%%" % (player["side"].get(True, 0.0) * 100)
+            for player in report))
+
+
+def timeline_series(game, reports):
+    # The timeline as JSON: each statement (null for the start) with every
+    # player's side and role odds after it.
+    series = []
+    for k, report in enumerate(reports):
+        series.append({
+            "statement": game.seen[k - 1] if k else None,
+            "players": [{"good": player["side"].get(True, 0.0),
+                         "role": player["role"]}
+                        for player in report]})
+    return series
+
+
+def eval_args(game, command_list):
+    args = {"length": 200 / (game.n_players - 4) * 2}
+    rest = [arg for arg in command_list[1:] if arg != ""]
+    while rest:
+        arg = rest.pop(0)
+        if arg == "--exact":
+            args["exact"] = True
+        elif arg == "--side-first":
+            args["side_first"] = True
+        elif arg == "--mcmc":
+            args["mcmc"] = True
+        elif arg == "-j":
+            args["workers"] = int(rest.pop(0))
+        elif arg == "--tol":
+            args["tolerance"] = float(rest.pop(0))
+        elif arg == "--time":
+            args["time_budget"] = float(rest.pop(0))
+        elif arg == "--seed":
+            args["seed"] = int(rest.pop(0))
+        else:
+            args["length"] = int(arg)
+    return args
+
+
+def repl_recommend(game, command_list, namemap):
+    # recommend team [size] / recommend lady <holder>
+    what_if = WhatIf(game)
+    option = command_list[1] if len(command_list) > 1 else "team"
+    print("Uncertainty about who's evil: %.2f bits" % what_if.uncertainty())
+    if option == "lady":
+        if len(command_list) < 3:
+            print(Fore.RED + "Who holds the Lady?")
+            return
+        for row in what_if.lady(int(command_list[2]))[:10]:
+            print("%-16s %5.2f bits  %5.1f%% claimed good" % (
+                namemap.get(row["target"], "") + " (%d)" % row["target"],
+                row["bits"], row["claims good"] * 100))
+        return
+    size = int(command_list[2]) if len(command_list) > 2 else None
+    for row in what_if.teams(size)[:10]:
+        print("%-24s %5.2f bits  %5.1f%% passes" % (
+            row["team"], row["bits"], row["passes"] * 100))
+
+
 def help():
     print(Fore.GREEN + "Initial Commands:")
     print("load <filename> -- Loads a savefile")
@@ -73,7 +335,62 @@ def help():
     print("mission -- Assert the results of a team and a mission")
     print("eval <repetitions> -- Quick eval, discounting special roles")
     print("fulleval <repetitions> -- Eval, counting special roles")
-    print("report -- Show last report again")
+    print("    --exact -- Weigh every deal exactly instead of sampling")
+    print("    --side-first -- Filter good/evil patterns before roles"
+          " (fulleval)")
+    print("    --mcmc -- Sample deals with swap moves instead of going"
+          " through the deck (fulleval; the default past a million deals"
+          " that known sides, roles and the like don't narrow down)")
+    print("    -j <workers> -- Split the evaluation across processes")
+    print("    --tol <fraction> -- Sample until each player's odds are"
+          " within +/- this")
+    print("    --time <seconds> -- Stop sampling after this long")
+    print("    --seed <number> -- Make the sampling repeatable")
+    print("    Evals run in the background, and restart when a statement is"
+          " added")
+    print("report -- Show the latest (possibly partial) report")
+    print("wait -- Wait for the running eval to finish, then report")
+    print("cancel -- Stop the running eval")
+    print("recommend team [size] -- The teams whose mission would tell the"
+          " most about who's evil, from the last eval")
+    print("recommend lady <holder> -- Likewise for whom the Lady looks at")
+    print("params -- Show the model's probabilities")
+    print("    load <file> -- Use the probabilities in a file (see fit.py)")
+    print("    save <file> -- Write them to a file")
+    print("sweep <name>=<p>,<p>... [<name>=...] [--quick] -- Exact odds for"
+          " every combination of model probabilities")
+    print("ensemble [<model> ...] [--quick] -- Exact odds under several"
+          " models side by side (default: this game's and BaselineModel)")
+    print("timeline [--quick] [--json <file>] -- Exact odds after each"
+          " assertion, in one pass")
+    print("stats -- Show what evaluating each assertion has cost")
+    print("    on/off -- Start/stop timing the model's functions")
+    print("    reset -- Forget the numbers so far")
+
+
+def eval_game(evaluated, game, busy=False):
+    # The game evals run on: one copy of `game` kept for the whole session
+    # and brought up to date with the statements added since, so its cached
+    # columns and check stats carry over from eval to eval. It's rebuilt
+    # when a statement was disbelieved or the parameters changed, or while
+    # a cancelled eval is still busy with it.
+    if busy or evaluated is None or \
+       evaluated.player_array != game.player_array or \
+       evaluated.model.parameters() != game.model.parameters() or \
+       evaluated.seen != game.seen[:len(evaluated.seen)]:
+        return game.copy()
+    evaluated.load_save(game.seen[len(evaluated.seen):])
+    return evaluated
+
+
+def restarted(background, evaluated, game):
+    # After a new statement: a running eval starts over with it, and a
+    # finished one no longer describes the game.
+    if background is None or background.done:
+        return None, evaluated
+    busy = not background.stop()
+    evaluated = eval_game(evaluated, game, busy)
+    return BackgroundEval(evaluated, background.args), evaluated
 
 
 def main():
@@ -83,6 +400,10 @@ def main():
 
     game = None
     namemap = {}
+    # The BackgroundEval behind `report`, if any, and the copy of the game
+    # that evals run on (see eval_game).
+    background = None
+    evaluated = None
 
     while True:
         try:
@@ -110,9 +431,8 @@ def main():
                         metadata = observations[0]
                         data = observations[1:]
 
-                        game = DeceptionGame(
-                            AvalonGame(int(metadata["game_size"])),
-                            DefaultModel)
+                        game = DeceptionGame(SavedGame(metadata),
+                                             DefaultModel)
                         namemap = metadata["player_names"]
                         game.load_save(data)
                 else:
@@ -129,7 +449,8 @@ def main():
                 round = int(raw_input("Round? ").strip())
                 fail_req = int(raw_input("# Fails Required? ").strip())
                 game.do_vote(team, votes, fail_req, round)
-                game.trace = {}
+                background, evaluated = restarted(background, evaluated,
+                                                  game)
                 continue
 
             elif command == "mission":
@@ -138,7 +459,8 @@ def main():
                 must = int(raw_input("Spys must fail? ").strip()) == 1
                 round = int(raw_input("Round? ").strip())
                 game.do_mission(team, fails, must, round)
-                game.trace = {}
+                background, evaluated = restarted(background, evaluated,
+                                                  game)
                 continue
 
             elif command == "lady" or command == "lol":
@@ -147,44 +469,117 @@ def main():
                 claim = int(raw_input("Claim? ").strip()) == 1
                 round = int(raw_input("Round? ").strip()) == 1
                 game.player_sees_player_and_claims(p1, p2, claim, round)
-                game.trace = {}
+                background, evaluated = restarted(background, evaluated,
+                                                  game)
                 continue
 
             elif command == "side":
                 p1 = int(raw_input("ID For Assertion? ").strip())
                 claim = int(raw_input("Good? ").strip()) == 1
                 game.add_known_alliance(p1, claim)
-                game.trace = {}
+                background, evaluated = restarted(background, evaluated,
+                                                  game)
                 continue
 
             elif command == "switch":
                 r = int(raw_input("Starting in round?").strip())
                 game.switch_lancelots(r)
-                game.trace = {}
+                background, evaluated = restarted(background, evaluated,
+                                                  game)
                 continue
 
-            elif command == "eval":
-                times = 200 / (game.n_players - 4) * 2
-                if len(command_list) > 1:
-                    times = int(command_list[1])
-                game.eval(times, quick=True)
-                repl_report(game.report(), namemap, game.n_good)
-            elif command == "fulleval":
-                times = 200 / (game.n_players - 4) * 2
-                if len(command_list) > 1:
-                    times = int(command_list[1])
-                game.eval(times)
-                repl_report(game.report(), namemap, game.n_good)
+            elif command == "eval" or command == "fulleval":
+                args = eval_args(game, command_list)
+                if command == "eval":
+                    args["quick"] = True
+                busy = background is not None and not background.stop()
+                evaluated = eval_game(evaluated, game, busy)
+                background = BackgroundEval(evaluated, args)
+                print("Evaluating in the background; 'report' shows the"
+                      " latest numbers, 'wait' waits for the end")
             elif command == "report":
-                repl_report(game.report(), namemap, game.n_good)
+                if background is not None:
+                    background_report(background, namemap, game.n_good)
+            elif command == "wait":
+                if background is not None:
+                    try:
+                        background.wait()
+                    except KeyboardInterrupt:
+                        background.cancel()
+                    background_report(background, namemap, game.n_good)
+            elif command == "cancel":
+                if background is not None:
+                    background.cancel()
+            elif command == "recommend":
+                # The finished eval's game has the deals to work from; a
+                # new statement since then has dropped it.
+                if background is None or not background.done:
+                    print(Fore.RED + "Needs a finished eval of the current"
+                          " statements (see eval, wait)")
+                    continue
+                repl_recommend(background.game, command_list, namemap)
+            elif command == "params":
+                option = command_list[1] if len(command_list) > 1 else ""
+                if option in ("load", "save") and len(command_list) < 3:
+                    print(Fore.RED + "Need a parameter file")
+                    continue
+                if option == "load":
+                    path = os.path.expanduser(command_list[2])
+                    with open(path, "r") as infile:
+                        game.set_parameters(json.load(infile))
+                    background, evaluated = restarted(
+                        background, evaluated, game)
+                elif option == "save":
+                    game.model.save_parameters(
+                        os.path.expanduser(command_list[2]))
+                for name, p in sorted(game.model.parameters().items()):
+                    print("%-30s %g" % (name, p))
+            elif command == "sweep":
+                settings, args = sweep_args(command_list)
+                if not settings or not settings[0]:
+                    print(Fore.RED + "Which parameters? See 'params'")
+                    continue
+                repl_sweep(game, settings, game.sweep(settings, **args),
+                           namemap)
+            elif command == "ensemble":
+                classes, args = ensemble_args(game, command_list)
+                repl_ensemble(game, classes, game.ensemble(classes, **args),
+                              namemap)
+            elif command == "timeline":
+                quick = "--quick" in command_list
+                reports = game.timeline(quick=quick)
+                if "--json" in command_list:
+                    at = command_list.index("--json") + 1
+                    if at >= len(command_list):
+                        print(Fore.RED + "Need an output file")
+                        continue
+                    outpath = os.path.expanduser(command_list[at])
+                    with open(outpath, "w") as outfile:
+                        json.dump(timeline_series(game, reports), outfile,
+                                  indent=2)
+                repl_timeline(game, reports, namemap)
+            elif command == "stats":
+                option = command_list[1] if len(command_list) > 1 else ""
+                # The eval-side copy of the game is the one collecting
+                # numbers.
+                games = [game]
+                if evaluated is not None:
+                    games.append(evaluated)
+                for g in games:
+                    if option == "on":
+                        g.profile(True)
+                    elif option == "off":
+                        g.profile(False)
+                    elif option == "reset":
+                        g.reset_stats()
+                if option not in ("on", "off", "reset"):
+                    repl_stats(games[-1].get_stats(), games[-1].seen,
+                               namemap)
             elif command == "save":
                 if len(command_list) < 2:
                     print(Fore.RED + "Need an output file")
                     continue
-                metadata = [{
-                    "game_size": game.n_players,
-                    "player_names": namemap
-                }]
+                metadata = [save_metadata(game, namemap)]
                 outpath = os.path.expanduser(command_list[1])
                 with open(outpath, "w") as savefile:
                     json.dump(metadata + game.seen, savefile, indent=2)
@@ -198,6 +593,8 @@ def main():
                     print(Fore.RED + "No args?")
                     continue
                 game.disbelieve(int(command_list[1]))
+                background, evaluated = restarted(background, evaluated,
+                                                  game)
             else:
                 print(Fore.RED + "Unknown command: %s" % command)
                 continue
@@ -0,0 +1,523 @@
+import numpy as np
+import time
+
+from deals import DealMatrix, Trace, lancelots_flipped
+from stats import ObservationStats
+
+
+# Statements whose likelihood doesn't involve the model's probabilities.
+PARAMETER_FREE = ("known_side", "known_role", "switch")
+
+# Full decks of more deals than this are never dealt out whole: only the
+# deals that fit the hard facts (known sides and roles, and what the model
+# is certain of) are, and only if there are no more of those than this.
+ENUMERATE_UP_TO = 1000000
+
+# How many of those fact-keyed decks (with their cached scores) to keep: the
+# game's own, and one for an ensemble whose models agree on fewer facts.
+CONSTRAINED_DECKS = 2
+
+
+def statement_round(statement):
+    # The 0-based round a statement is about, the way the observation
+    # closures compute it; None for statements that aren't about a round.
+    type = statement["type"]
+    if type in ("vote", "mission"):
+        return statement["round"] - 1
+    if type == "lady":
+        return int(statement.get("round", -1)) - 1
+    return None
+
+
+class VectorEvaluator(object):
+    # Scores a whole deck against a game's statements at once.
+    #
+    # Rather than calling observation closures deal by deal, every statement
+    # in game.seen is turned into a per-deal probability with the model's
+    # vec_* functions (or a plain mask for known sides and roles). Deals that
+    # reach probability zero are dropped before the next statement runs.
+    #
+    # Those probabilities are kept per observation (keyed by game.tids), so
+    # a new statement is only scored against the deals that survive the
+    # others, and disbelieving one just recombines what's already known.
+    # Deals that a disbelieved statement had pruned get scored lazily by the
+    # later statements on the next pass.
+    #
+    # Matrices and caches are keyed by (quick, shard): which deck, and which
+    # slice of it this process is responsible for. A full deck too big to
+    # deal out is keyed by its hard facts as well, and holds only the deals
+    # that fit them.
+    def __init__(self, game):
+        self.game = game
+        self.matrices = {}
+        self.cache = {}
+        self.cache_switches = {}
+        self.rejects = {}
+        self.patterns = {}
+        # ObservationStats per tid, for DeceptionGame.get_stats.
+        self.stats = {}
+        self.facts_for = None
+        # Keys of decks that turned out to hold too many deals to deal out.
+        self.too_big = set()
+        # Keys of the fact-keyed decks dealt out, least recently used first.
+        self.constrained = []
+
+    def key(self, quick, models=None):
+        # Big decks are keyed by the hard facts too, since those decide
+        # which deals they hold; `models` are the ones whose certain facts
+        # all have to agree (by default, the game's).
+        if quick or len(self.game.all_permutations) <= ENUMERATE_UP_TO:
+            return (quick, self.game.shard)
+        return (quick, self.game.shard, self.facts(models))
+
+    def matrix(self, key):
+        if len(key) == 3 and key in self.constrained:
+            self.constrained.remove(key)
+            self.constrained.append(key)
+        if key not in self.matrices:
+            if len(key) == 3:
+                return self.constrained_matrix(key)
+            quick, shard = key
+            if quick:
+                deck = self.game.quick_permutations
+            else:
+                deck = self.game.all_permutations
+            start, stop = shard or (0, len(deck))
+            self.matrices[key] = DealMatrix.shared(deck, start, stop)
+        return self.matrices[key]
+
+    def enumerable(self, quick=False):
+        # Whether the deck (or the part of it the hard facts leave) is
+        # small enough to go through deal by deal.
+        try:
+            self.matrix(self.key(quick))
+        except ValueError:
+            return False
+        return True
+
+    def facts(self, models=None):
+        # What the statements say for certain about each seat's card: the
+        # known sides and roles, and what each of `models` is certain of
+        # whatever its probabilities. A sorted tuple of (condition player or
+        # None, condition cards, player, cards), the cards as a tuple of
+        # flags over deck.cards.
+        if models is None:
+            models = [self.game.model]
+        # certain() doesn't depend on a model's probabilities, so its class
+        # will do; ids get reused once ensemble()'s models are collected.
+        memo = (tuple(self.game.tids), tuple(self.game.lancelots_switch_at),
+                tuple(model.__class__ for model in models))
+        if self.facts_for is not None and self.facts_for[0] == memo:
+            return self.facts_for[1]
+        cards = self.game.all_permutations.cards
+        switches = self.game.lancelots_switch_at
+        lance = [role in ("GLance", "ELance") for role, _ in cards]
+
+        def flags(test, rnd):
+            flipped = lancelots_flipped(switches, rnd)
+            return tuple(bool(test(role, good != (flipped and lancelot)))
+                         for (role, good), lancelot in zip(cards, lance))
+
+        out = set()
+        certain = [set() for model in models]
+        for statement in self.game.seen:
+            type = statement["type"]
+            if type == "known_side":
+                out.add((None, None, statement["player"],
+                         flags(lambda role, good:
+                               good == statement["is good"], None)))
+            elif type == "known_role":
+                out.add((None, None, statement["player"],
+                         flags(lambda role, good:
+                               role == statement["role"], None)))
+            elif type not in PARAMETER_FREE:
+                rnd = statement_round(statement)
+                for model, found in zip(models, certain):
+                    for condition, player, test in model.certain(statement):
+                        if condition is None:
+                            found.add((None, None, player, flags(test, rnd)))
+                        else:
+                            found.add((condition[0],
+                                       flags(condition[1], rnd), player,
+                                       flags(test, rnd)))
+        out |= set.intersection(*certain)
+        facts = tuple(sorted(out))
+        self.facts_for = (memo, facts)
+        return facts
+
+    def constrained_matrix(self, key):
+        # The deals of the full deck that fit key's facts, in deck order (or
+        # the shard's slice of them).
+        quick, shard, facts = key
+        cards = None
+        if key not in self.too_big:
+            deck = self.game.all_permutations
+            allowed = np.ones((deck.n_players, len(deck.cards)), dtype=bool)
+            rules = []
+            for condition_player, condition, player, flags in facts:
+                if condition_player is None:
+                    allowed[player] &= np.array(flags)
+                else:
+                    rules.append((condition_player, np.array(condition),
+                                  player, np.array(flags)))
+            cards = deck.consistent(allowed, rules, limit=ENUMERATE_UP_TO)
+        if cards is None:
+            self.too_big.add(key)
+            raise ValueError("More than %d deals fit what's known for "
+                             "certain; sample them with MCMC" %
+                             ENUMERATE_UP_TO)
+        start, stop = shard or (0, len(cards))
+        # Facts change as statements come and go, so only the most recently
+        # used decks (and their scores) are kept.
+        self.constrained.append(key)
+        while len(self.constrained) > CONSTRAINED_DECKS:
+            old = self.constrained.pop(0)
+            for table in (self.matrices, self.cache, self.cache_switches,
+                          self.rejects, self.patterns):
+                table.pop(old, None)
+        self.matrices[key] = DealMatrix.from_cards(deck, cards[start:stop])
+        return self.matrices[key]
+
+    def observation_cache(self, key):
+        # Lancelot switches change everyone's per-round alignment, so the
+        # cached probabilities only hold for the switches they were made with.
+        switches = tuple(self.game.lancelots_switch_at)
+        if self.cache_switches.get(key) != switches:
+            self.cache[key] = {}
+            self.cache_switches[key] = switches
+        cache = self.cache[key]
+        for tid in list(cache):
+            if tid not in self.game.tids:
+                del cache[tid]
+                self.rejects.get(key, {}).pop(tid, None)
+        return cache
+
+    def closure_likelihood(self, obs, deals):
+        # For models without vec_* functions: run the observation closures in
+        # exact mode, one deal at a time.
+        model = self.game.model
+        out = np.zeros(len(deals))
+        self.game.deal_rows = deals.matrix.rows()
+        model.exact = True
+        try:
+            for j, deal in enumerate(deals.idx.tolist()):
+                weight = 1.0
+                for f in obs:
+                    weight *= f(deal) or 0.0
+                    if not weight:
+                        break
+                out[j] = weight
+        finally:
+            model.exact = False
+        return out
+
+    def likelihood(self, statement, deals, obs=None):
+        model = self.game.model
+        type = statement["type"]
+        if type == "known_side":
+            return (deals.is_good(statement["player"], None) ==
+                    statement["is good"]).astype(float)
+        elif type == "known_role":
+            return deals.is_role(statement["player"],
+                                 statement["role"]).astype(float)
+        elif type == "switch":
+            return np.ones(len(deals))
+        elif obs is not None:
+            return self.closure_likelihood(obs, deals)
+        elif type == "vote":
+            return model.timed(model.vec_votes)(
+                deals,
+                statement["team"],
+                statement["votes"],
+                statement["fails required"],
+                statement_round(statement))
+        elif type == "mission":
+            return model.timed(model.vec_mission)(
+                deals,
+                statement["team"],
+                statement["fails"],
+                statement["must fail"],
+                statement_round(statement))
+        elif type == "lady":
+            return model.timed(model.vec_player_sees_player_and_claims)(
+                deals,
+                statement["p1"],
+                statement["p2"],
+                statement["is good"],
+                statement_round(statement))
+        return np.ones(len(deals))
+
+    def depends_on_roles(self, statement):
+        # False when the statement's likelihood is a function of the
+        # starting alignment alone, so it can be scored on the quick deck.
+        type = statement["type"]
+        if type in ("known_side", "switch"):
+            return False
+        if type == "known_role":
+            return True
+        roles = set(card[0] for card in self.game.all_permutations.cards)
+        if ("GLance" in roles or "ELance" in roles) and \
+           lancelots_flipped(self.game.lancelots_switch_at,
+                             statement_round(statement)):
+            return True
+        return self.game.model.depends_on_roles(statement, roles)
+
+    def combine(self, key, statements, alive, weights, vectorized=True):
+        # Multiplies the (cached) columns of `statements` into `weights`,
+        # dropping deals as they reach zero.
+        matrix = self.matrix(key)
+        cache = self.observation_cache(key)
+        rejects = self.rejects.setdefault(key, {})
+        for tid, statement, obs in self.ordered(key, statements):
+            before = len(alive)
+            if tid not in cache:
+                cache[tid] = np.empty(len(matrix))
+                cache[tid].fill(np.nan)
+            column = cache[tid]
+            missing = alive[np.isnan(column[alive])]
+            if len(missing):
+                started = time.time()
+                deals = matrix.view(missing, self.game.lancelots_switch_at)
+                scored = self.likelihood(statement, deals,
+                                         None if vectorized else obs)
+                column[missing] = scored
+                self.record(tid, scored, time.time() - started)
+            weights *= column[alive]
+            keep = weights > 0
+            alive = alive[keep]
+            weights = weights[keep]
+            if before:
+                rejects[tid] = 1.0 - len(alive) / float(before)
+        return alive, weights
+
+    def forget_model_columns(self):
+        # After the model's parameters change: drop the cached columns that
+        # were computed with the old ones.
+        stale = set(tid for tid, statement in zip(self.game.tids,
+                                                  self.game.seen)
+                    if statement["type"] not in PARAMETER_FREE)
+        for key, cache in self.cache.items():
+            for tid in stale:
+                cache.pop(tid, None)
+                self.rejects.get(key, {}).pop(tid, None)
+
+    def record(self, tid, scored, seconds):
+        if tid not in self.stats:
+            self.stats[tid] = ObservationStats()
+        stats = self.stats[tid]
+        possible = scored[scored > 0]
+        stats.calls += len(scored)
+        stats.seconds += seconds
+        stats.trues += float(possible.sum())
+        stats.falses += float(len(possible) - possible.sum())
+        stats.nones += len(scored) - len(possible)
+
+    def statements(self):
+        return list(zip(self.game.tids, self.game.seen,
+                        self.game.observations))
+
+    def ordered(self, key, statements):
+        # Statements that were already scored go first, the ones that
+        # ruled out the largest share of deals leading, so new statements
+        # (the expensive part) only see the deals that survive the rest.
+        # The product of the columns doesn't depend on the order.
+        rejects = self.rejects.setdefault(key, {})
+        return sorted(statements,
+                      key=lambda s: (s[0] not in rejects,
+                                     -rejects.get(s[0], 0.0)))
+
+    def pattern_ids(self, key):
+        # For each deal of a full matrix, the index of its starting alignment
+        # in the (unsharded) quick deck.
+        if key not in self.patterns:
+            quick_masks = self.matrix((True, None)).good
+            order = np.argsort(quick_masks)
+            found = np.searchsorted(quick_masks[order],
+                                    self.matrix(key).good)
+            self.patterns[key] = order[found]
+        return self.patterns[key]
+
+    def weights(self, quick, vectorized=True, side_first=False):
+        # Returns the matrix key, the indices of the deals that can still
+        # happen, and the probability that each one passes every statement.
+        if side_first and not quick:
+            return self.side_first_weights(vectorized)
+        key = self.key(quick)
+        alive = np.arange(len(self.matrix(key)))
+        alive, weights = self.combine(key, self.statements(), alive,
+                                      np.ones(len(alive)), vectorized)
+        return key, alive, weights
+
+    def side_first_weights(self, vectorized=True):
+        # Two stages: statements that only depend on alignment are scored on
+        # the quick deck of good/evil patterns, and only the full deals whose
+        # pattern survives are scored against the role-dependent rest
+        # (Merlin and Mordred votes, anything after a Lancelot switch, ...).
+        # The result is the same as a full evaluation.
+        side_only = []
+        role_dependent = []
+        for statement in self.statements():
+            if self.depends_on_roles(statement[1]):
+                role_dependent.append(statement)
+            else:
+                side_only.append(statement)
+        quick_key = (True, None)
+        patterns = np.arange(len(self.matrix(quick_key)))
+        patterns, pattern_weights = self.combine(
+            quick_key, side_only, patterns, np.ones(len(patterns)),
+            vectorized)
+        by_pattern = np.zeros(len(self.matrix(quick_key)))
+        by_pattern[patterns] = pattern_weights
+
+        key = self.key(False)
+        deal_patterns = self.pattern_ids(key)
+        alive = np.nonzero(by_pattern[deal_patterns])[0]
+        weights = by_pattern[deal_patterns[alive]]
+        alive, weights = self.combine(key, role_dependent, alive, weights,
+                                      vectorized)
+        return key, alive, weights
+
+    def possible(self, key, vectorized=True):
+        # The deals no setting of the model's parameters rules out, with
+        # their weight from the parameter-free statements: those statements
+        # come from the usual cache, and the others are scored with every
+        # probability at one half. A zero there comes from the rules rather
+        # than from the numbers.
+        model = self.game.model
+        matrix = self.matrix(key)
+        switches = self.game.lancelots_switch_at
+        fixed = []
+        scored = []
+        for statement in self.statements():
+            if statement[1]["type"] in PARAMETER_FREE:
+                fixed.append(statement)
+            else:
+                scored.append(statement)
+        alive = np.arange(len(matrix))
+        alive, weights = self.combine(key, fixed, alive,
+                                      np.ones(len(alive)), vectorized)
+        base = model.parameters()
+        try:
+            model.set_parameters(dict.fromkeys(base, 0.5))
+            for tid, statement, obs in self.ordered(key, scored):
+                possible = self.likelihood(
+                    statement, matrix.view(alive, switches),
+                    None if vectorized else obs) > 0
+                alive = alive[possible]
+                weights = weights[possible]
+        finally:
+            model.set_parameters(base)
+        return alive, weights
+
+    def sweep(self, settings, quick=False, vectorized=True):
+        # Yields a Trace of exact weights for each of `settings`, a list of
+        # {parameter name: probability} overrides for the model.
+        #
+        # The work that doesn't depend on the probabilities is done once
+        # (see possible()); only the surviving deals are scored again per
+        # setting.
+        model = self.game.model
+        key = self.key(quick)
+        matrix = self.matrix(key)
+        switches = self.game.lancelots_switch_at
+        scored = self.ordered(key, [s for s in self.statements()
+                                    if s[1]["type"] not in PARAMETER_FREE])
+        base = model.parameters()
+        for setting in settings:
+            for name in setting:
+                model.parameter(name)
+        alive, weights = self.possible(key, vectorized)
+        try:
+            for setting in settings:
+                model.set_parameters(dict(base, **setting))
+                setting_alive = alive
+                setting_weights = weights
+                for tid, statement, obs in scored:
+                    setting_weights = setting_weights * self.likelihood(
+                        statement, matrix.view(setting_alive, switches),
+                        None if vectorized else obs)
+                    keep = setting_weights > 0
+                    setting_alive = setting_alive[keep]
+                    setting_weights = setting_weights[keep]
+                trace = Trace(matrix)
+                trace.counts[setting_alive] = setting_weights
+                yield trace
+        finally:
+            model.set_parameters(base)
+
+    def ensemble(self, models, quick=False, vectorized=None):
+        # Yields a Trace of exact weights for each of `models` (instances
+        # made for this game), scored in turn as game.model. The known sides
+        # and roles filter the deck once; each model then only scores the
+        # deals that survive them. vectorized, if given, is a flag per
+        # model.
+        key = self.key(quick, models)
+        matrix = self.matrix(key)
+        switches = self.game.lancelots_switch_at
+        if vectorized is None:
+            vectorized = [model.vectorized for model in models]
+        fixed = []
+        scored = []
+        for statement in self.statements():
+            if statement[1]["type"] in PARAMETER_FREE:
+                fixed.append(statement)
+            else:
+                scored.append(statement)
+        alive = np.arange(len(matrix))
+        alive, weights = self.combine(key, fixed, alive,
+                                      np.ones(len(alive)))
+        scored = self.ordered(key, scored)
+        base = self.game.model
+        try:
+            for model, vec in zip(models, vectorized):
+                self.game.model = model
+                model_alive = alive
+                model_weights = weights
+                for tid, statement, obs in scored:
+                    model_weights = model_weights * self.likelihood(
+                        statement, matrix.view(model_alive, switches),
+                        None if vec else obs)
+                    keep = model_weights > 0
+                    model_alive = model_alive[keep]
+                    model_weights = model_weights[keep]
+                trace = Trace(matrix)
+                trace.counts[model_alive] = model_weights
+                yield trace
+        finally:
+            self.game.model = base
+
+    def timeline(self, quick=False, vectorized=True):
+        # Yields a Trace of exact weights before any statement and after
+        # each one, in game.seen order: a single pass over the deck, each
+        # statement scored (or taken from the cache) only for the deals
+        # the ones before it left.
+        key = self.key(quick)
+        if len(key) == 3:
+            raise ValueError("The deck is too big to go through without "
+                             "the later statements' hard facts")
+        matrix = self.matrix(key)
+        alive = np.arange(len(matrix))
+        weights = np.ones(len(alive))
+        trace = Trace(matrix)
+        trace.counts[alive] = weights
+        yield trace
+        for statement in self.statements():
+            alive, weights = self.combine(key, [statement], alive, weights,
+                                          vectorized)
+            trace = Trace(matrix)
+            trace.counts[alive] = weights
+            yield trace
+
+    def exact(self, quick, vectorized=True, side_first=False):
+        key, alive, weights = self.weights(quick, vectorized, side_first)
+        trace = Trace(self.matrix(key))
+        trace.counts[alive] = weights
+        return trace
+
+    def sample(self, length, quick, vectorized=True, side_first=False):
+        # Equivalent to running the deck `length` times and counting how
+        # often each deal passes every (independent) check.
+        key, alive, weights = self.weights(quick, vectorized, side_first)
+        trace = Trace(self.matrix(key))
+        trace.counts[alive] = self.game.random.binomial(length, weights)
+        return trace